@@ -0,0 +1,85 @@
+#!/usr/bin/env python2.7
+
+""" Benchmarks the camera capture backends.
+
+Compares starting a capture process for every frame, which is what Camera used
+to do with raspistill, against keeping one process running and splitting the
+frames out of its output. The synthetic stream of the capture module stands in
+for the camera, so the numbers only show the process and pipe overhead and
+leave out the warm-up time of the real camera, which makes the per-frame
+process look better than it is on a Pi.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import os
+import subprocess
+import sys
+import time
+
+import capture
+
+
+def streamArgs(frames):
+    return [sys.executable, os.path.abspath(capture.__file__), '-r', '0', '-n', str(frames)]
+
+
+def benchSpawn(frames):
+    """ One capture process per frame.
+    """
+    for i in range(frames):
+        data = subprocess.check_output(streamArgs(1))
+        assert capture.JpegSplitter().feed(data)
+
+
+def benchPipe(frames):
+    """ One capture process for all of the frames.
+    """
+    backend = capture.PipeBackend(streamArgs(0))
+    backend.start()
+    try:
+        for i in range(frames):
+            backend.capture()
+    finally:
+        backend.stop()
+
+
+def benchSynthetic(frames):
+    """ Frames drawn in process, the cost of the frames themselves.
+    """
+    backend = capture.SyntheticBackend()
+    for i in range(frames):
+        backend.capture()
+
+
+def benchSplitter(frames):
+    """ Splitting frames out of a stream in 64 KiB reads.
+    """
+    backend = capture.SyntheticBackend()
+    stream = b''.join(backend.capture() for i in range(50))
+    splitter = capture.JpegSplitter()
+    start = time.time()
+    count = 0
+    for i in range(frames // 50 + 1):
+        for offset in range(0, len(stream), 65536):
+            count += len(splitter.feed(stream[offset:offset + 65536]))
+    elapsed = time.time() - start
+    print('%-12s %8d %10.3f %10.1f %10.1f' % ('splitter', count, elapsed * 1e3 / count, count / elapsed, len(stream) * (frames // 50 + 1) / elapsed / 1e6))
+
+
+def main():
+    frames = 50
+    if len(sys.argv) > 1:
+        frames = int(sys.argv[1])
+
+    print('%-12s %8s %10s %10s %10s' % ('backend', 'frames', 'ms/frame', 'frames/s', 'MB/s'))
+    for (name, bench) in [('spawn', benchSpawn), ('pipe', benchPipe), ('synthetic', benchSynthetic)]:
+        start = time.time()
+        bench(frames)
+        elapsed = time.time() - start
+        print('%-12s %8d %10.3f %10.1f' % (name, frames, elapsed * 1e3 / frames, frames / elapsed))
+    benchSplitter(frames * 10)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python2.7
+
+""" Benchmarks motion detection on the camera.
+
+Runs the synthetic camera through a script of still and busy periods on a
+virtual clock, once keeping every frame at the camera rate and once with the
+motion detector and the adaptive rate, and compares the frames captured and
+kept, the bytes kept and how long it took to see motion after a still period.
+Also times the check of a single frame.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import sys
+import time
+
+import capture
+import motion
+
+
+# Seconds of each period and whether something moves in it.
+SCRIPT = [(60, False), (10, True), (120, False), (5, True), (60, False), (20, True)]
+
+
+def simulate(fps, idle):
+    """ Returns the frames captured and kept, the bytes kept and the worst
+        delay in seconds between the start of a busy period and the first
+        frame kept in it.
+    """
+    backend = capture.SyntheticBackend()
+    detector = None
+    rate = None
+    if idle > 0:
+        detector = motion.MotionDetector()
+        rate = motion.AdaptiveRate(idle)
+
+    (captured, kept, size, latency) = (0, 0, 0, 0.0)
+    now = 0.0
+    end = sum(length for (length, moving) in SCRIPT)
+    seen = set()
+    while True:
+        interval = 1.0 / fps
+        if rate is not None:
+            interval = rate.interval(interval)
+        now += interval
+        if now >= end:
+            break
+
+        # Find the period of the script at the time of the frame.
+        start = 0.0
+        for (length, moving) in SCRIPT:
+            if now < start + length:
+                break
+            start += length
+        backend.moving = moving
+
+        data = backend.capture()
+        captured += 1
+        changed = True
+        if detector is not None:
+            (changed, score) = detector.check(data)
+            rate.update(changed)
+        if changed:
+            kept += 1
+            size += len(data)
+            if moving and start not in seen:
+                seen.add(start)
+                latency = max(latency, now - start)
+    return (captured, kept, size, latency)
+
+
+def benchCheck(frames):
+    """ Milliseconds to check a frame.
+    """
+    backend = capture.SyntheticBackend()
+    data = [backend.capture() for i in range(20)]
+    detector = motion.MotionDetector()
+    begin = time.time()
+    for i in range(frames):
+        detector.check(data[i % len(data)])
+    return (time.time() - begin) * 1e3 / frames
+
+
+def main():
+    if not motion.available():
+        print('Motion detection needs NumPy and PIL.')
+        sys.exit(1)
+    fps = 2
+    if len(sys.argv) > 1:
+        fps = float(sys.argv[1])
+
+    print('%-10s %9s %9s %10s %10s' % ('mode', 'captured', 'kept', 'KiB kept', 'latency s'))
+    for (name, idle) in [('every', 0), ('idle 5', 5), ('idle 10', 10)]:
+        (captured, kept, size, latency) = simulate(fps, idle)
+        print('%-10s %9d %9d %10.0f %10.2f' % (name, captured, kept, size / 1024.0, latency))
+    print('check %.3f ms/frame' % benchCheck(200))
+
+if __name__ == '__main__':
+    main()
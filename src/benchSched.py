@@ -0,0 +1,73 @@
+#!/usr/bin/env python2.7
+
+""" Benchmarks reconciling feeder schedules.
+
+Times schedule.diffSched and FeedScheduler.apply on schedules of growing size
+where a tenth of the entries are replaced on every change, which is what the
+one-shot heavy and multi-feeder configurations look like. The time per entry
+should stay flat as the schedule grows.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import random
+import sys
+import time
+
+import schedule
+
+
+def makeScheds(size, churn):
+    """ Returns an old and a new sorted schedule of the given size that differ
+        by churn entries in each direction.
+    """
+    keys = random.sample(range(size * 4), size + churn)
+    old = sorted(keys[:size])
+    new = sorted(keys[churn:])
+    return (old, new)
+
+
+def diffQuadratic(old, new):
+    """ The list membership reconciliation Feeder.updateSched used to do.
+    """
+    added = [key for key in new if key not in old]
+    removed = [key for key in old if key not in new]
+    return schedule.SchedDelta(added, removed)
+
+
+def bench(size, repeat, quadratic):
+    (old, new) = makeScheds(size, size // 10)
+
+    start = time.time()
+    for i in range(repeat):
+        delta = schedule.diffSched(old, new)
+    diffTime = (time.time() - start) / repeat
+
+    scheduler = schedule.FeedScheduler()
+    scheduler.apply(schedule.SchedDelta(old, []), float)
+    start = time.time()
+    scheduler.apply(delta, float)
+    applyTime = time.time() - start
+    assert len(scheduler) == len(new)
+
+    line = '%8d %10.3f %10.3f %10.1f' % (size, diffTime * 1e3, applyTime * 1e3, (diffTime + applyTime) / size * 1e9)
+    if quadratic:
+        start = time.time()
+        diffQuadratic(old, new)
+        line += ' %12.3f' % ((time.time() - start) * 1e3)
+    print(line)
+
+
+def main():
+    sizes = [1000, 2000, 4000, 8000, 16000, 32000, 64000]
+    if len(sys.argv) > 1:
+        sizes = [int(arg) for arg in sys.argv[1:]]
+
+    random.seed(0)
+    print('%8s %10s %10s %10s %12s' % ('entries', 'diff ms', 'apply ms', 'ns/entry', 'list diff ms'))
+    for size in sizes:
+        bench(size, 5, size <= 8000)
+
+if __name__ == '__main__':
+    main()
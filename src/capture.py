@@ -0,0 +1,519 @@
+#!/usr/bin/env python2.7
+
+""" Camera capture backends of the feeders.
+
+Frames are kept in a FrameRing, a bounded ring of the last frames in memory,
+from which they are served without going through the SD card. The ring can
+scale every frame down to smaller renditions once as it is pushed, so pages
+showing many feeders can fetch small images without resizing per request.
+
+A backend keeps one capture process running and reads the JPEG frames it
+writes to its standard output, instead of starting raspistill, and waiting for
+the camera to warm up, for every frame. The frames are split out of the byte
+stream by walking the JPEG markers. The synthetic backend draws frames in
+process so the camera code can be tested and benchmarked without a camera.
+
+Run as a script, writes a stream of synthetic frames to standard output, which
+stands in for the camera process of the pipe backend.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import argparse
+import base64
+import binascii
+import collections
+import io
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorCapture(Error):
+    """ Raised when the capture process fails.
+    """
+    def __init__(self, backend, reason):
+        self.msg = 'error: %s capture failed: %s' % (backend, reason)
+
+
+SOI = b'\xff\xd8'
+EOI = 0xd9
+SOS = 0xda
+MAX_FRAME = 8 * 1024 * 1024
+
+# Renditions of the frames by name, with their largest width and height.
+SIZES = collections.OrderedDict([('medium', (320, 180)), ('thumb', (160, 90))])
+
+
+class JpegSplitter(object):
+    """ Splits a stream of concatenated JPEG images into frames.
+
+        The marker segments of the header are skipped by their length, so an
+        EXIF thumbnail cannot be mistaken for the end of the frame, and only
+        the entropy-coded data is scanned for the EOI marker. The scan resumes
+        where the previous call stopped.
+    """
+    def __init__(self, maxSize=MAX_FRAME):
+        self.maxSize = maxSize
+        self.buf = bytearray()
+        self.scan = 0
+
+    def feed(self, data):
+        """ Adds data read from the stream and returns a list of the frames
+            completed by it.
+        """
+        self.buf.extend(data)
+        frames = []
+        while True:
+            frame = self.next()
+            if frame is None:
+                break
+            frames.append(frame)
+        if len(self.buf) > self.maxSize:
+            self.buf = bytearray()
+            self.scan = 0
+            raise Error('frame larger than %d bytes' % self.maxSize)
+        return frames
+
+    def next(self):
+        buf = self.buf
+        if not self.scan:
+            # Drop anything before the start of the frame.
+            start = buf.find(SOI)
+            if start < 0:
+                del buf[:-1]
+                return None
+            del buf[:start]
+
+            # Skip the header segments up to the start of the scan.
+            pos = 2
+            while True:
+                if len(buf) < pos + 4:
+                    return None
+                if buf[pos] != 0xff:
+                    # Not a JPEG after all, look for the next one.
+                    del buf[:2]
+                    return self.next()
+                marker = buf[pos + 1]
+                if marker == 0xff:
+                    pos += 1
+                    continue
+                pos += 2 + (buf[pos + 2] << 8 | buf[pos + 3])
+                if marker == SOS:
+                    break
+            self.scan = pos
+
+        # Scan the entropy-coded data, where 0xff is only followed by a
+        # stuffed zero, a restart marker or another segment.
+        pos = self.scan
+        while True:
+            i = buf.find(b'\xff', pos)
+            if i < 0 or i + 1 >= len(buf):
+                self.scan = len(buf) if i < 0 else i
+                return None
+            marker = buf[i + 1]
+            if marker == 0 or marker == 0xff or 0xd0 <= marker <= 0xd7:
+                pos = i + 1
+            elif marker == EOI:
+                frame = bytes(buf[:i + 2])
+                del buf[:i + 2]
+                self.scan = 0
+                return frame
+            else:
+                # Segments between the scans of a progressive JPEG.
+                if i + 4 > len(buf):
+                    self.scan = i
+                    return None
+                pos = i + 2 + (buf[i + 2] << 8 | buf[i + 3])
+                if pos > len(buf):
+                    self.scan = i
+                    return None
+
+
+def scale(data, sizes, quality=70):
+    """ Returns a dictionary mapping the names of sizes to the JPEG frame data
+        scaled down to fit them, keeping its aspect ratio. Each rendition is
+        scaled from the previous one, so sizes should go from largest to
+        smallest. Returns an empty dictionary without PIL or if the frame
+        cannot be decoded.
+    """
+    renditions = {}
+    if Image is None or not sizes:
+        return renditions
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder do most of the downsampling.
+        image.draft(image.mode, max(sizes.values()))
+        image.load()
+        for (name, size) in sizes.items():
+            image.thumbnail(size)
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=quality)
+            renditions[name] = out.getvalue()
+    except (IOError, ValueError):
+        return {}
+    return renditions
+
+
+class Frame(object):
+    """ A captured frame with its sequence number, capture time and smaller
+        renditions by name.
+    """
+    def __init__(self, seq, when, data, renditions=None):
+        self.seq = seq
+        self.when = when
+        self.data = data
+        self.renditions = renditions or {}
+        self.checksum = None
+
+    def rendition(self, name=None):
+        """ Returns the data of the rendition name, or the full frame if name
+            is None or the rendition could not be made.
+        """
+        return self.renditions.get(name, self.data)
+
+    def crc(self):
+        """ Returns the CRC-32 of the frame, computed on first use.
+        """
+        if self.checksum is None:
+            self.checksum = binascii.crc32(self.data) & 0xffffffff
+        return self.checksum
+
+
+class FrameRing(object):
+    """ Bounded ring of the last frames. Pushing a frame drops the oldest
+        one once the ring is full. Frames are scaled to the renditions in
+        sizes as they are pushed.
+    """
+    def __init__(self, size=16, sizes=None):
+        self.frames = collections.deque(maxlen=size)
+        self.sizes = sizes or collections.OrderedDict()
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def addListener(self, listener):
+        """ Calls listener with every frame pushed from now on, on the thread
+            that pushes it.
+        """
+        self.listeners.append(listener)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, data, when=None):
+        """ Adds a frame and returns it.
+        """
+        # Scale outside of the lock, on the thread that pushes the frame.
+        renditions = scale(data, self.sizes)
+        with self.lock:
+            self.seq += 1
+            frame = Frame(self.seq, time.time() if when is None else when, data, renditions)
+            self.frames.append(frame)
+        for listener in self.listeners:
+            listener(frame)
+        return frame
+
+    def latest(self):
+        """ Returns the newest frame, or None if the ring is empty.
+        """
+        with self.lock:
+            if self.frames:
+                return self.frames[-1]
+        return None
+
+    def get(self, seq):
+        """ Returns the frame with sequence number seq, or None if it is not
+            in the ring.
+        """
+        with self.lock:
+            if self.frames:
+                i = seq - self.frames[0].seq
+                if 0 <= i < len(self.frames):
+                    return self.frames[i]
+        return None
+
+    def find(self, crc):
+        """ Returns the newest frame with the CRC-32 crc, or None.
+        """
+        with self.lock:
+            frames = list(self.frames)
+        for frame in reversed(frames):
+            if frame.crc() == crc:
+                return frame
+        return None
+
+
+class Backend(object):
+    """ Interface of the capture backends.
+    """
+    name = 'none'
+
+    def start(self):
+        pass
+
+    def capture(self):
+        """ Returns the next frame as JPEG data.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+# Gray 16 x 16 JPEG used by the synthetic backend when PIL is missing.
+BLANK_JPEG = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQAAAQABAAD/2wBDABALDA4MChAODQ4SERATGCgaGBYWGDEjJR0oOjM9'
+    'PDkzODdASFxOQERXRTc4UG1RV19iZ2hnPk1xeXBkeFxlZ2P/wAALCAAQABABAREA/8QAHwAA'
+    'AQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQR'
+    'BRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RF'
+    'RkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ip'
+    'qrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/9oACAEB'
+    'AAA/ACiiiv/Z')
+
+
+class SyntheticBackend(Backend):
+    """ Draws frames in process, with a box moving across a gray background
+        while moving is set, and the frame number. Without PIL every frame is
+        a small blank image that carries the frame number in a comment
+        segment.
+    """
+    name = 'synthetic'
+
+    def __init__(self, width=640, height=360, quality=75):
+        self.width = width
+        self.height = height
+        self.quality = quality
+        self.frameNo = 0
+        self.moving = True
+        self.x = 0
+
+    def capture(self):
+        self.frameNo += 1
+        if self.moving:
+            self.x += 8
+        text = 'frame %d %.3f' % (self.frameNo, time.time())
+        if Image is None:
+            comment = text.encode('ascii')
+            return SOI + b'\xff\xfe' + struct.pack('!H', len(comment) + 2) + comment + BLANK_JPEG[2:]
+
+        image = Image.new('L', (self.width, self.height), 96)
+        draw = ImageDraw.Draw(image)
+        size = max(self.height // 6, 1)
+        x = self.x % max(self.width - size, 1)
+        draw.rectangle([x, self.height // 2 - size // 2, x + size, self.height // 2 + size // 2], fill=224)
+        draw.text((8, 8), text, fill=255)
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=self.quality)
+        return out.getvalue()
+
+
+class ProcessBackend(Backend):
+    """ Base of the backends that read frames from the standard output of a
+        long-running capture process.
+    """
+    def __init__(self, args, timeout=10, readSize=65536):
+        self.args = args
+        self.timeout = timeout
+        self.readSize = readSize
+        self.process = None
+        self.splitter = JpegSplitter()
+
+    def start(self):
+        with open(os.devnull, 'wb') as devnull:
+            try:
+                self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=devnull, bufsize=0)
+            except OSError as e:
+                raise ErrorCapture(self.name, '%s: %s' % (self.args[0], e.strerror))
+        self.splitter = JpegSplitter()
+
+    def read(self, timeout):
+        """ Reads from the capture process and returns the frames completed,
+            or an empty list if nothing arrived within timeout.
+        """
+        if self.process is None:
+            raise ErrorCapture(self.name, 'not started')
+        fd = self.process.stdout.fileno()
+        (readable, writable, errors) = select.select([fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(fd, self.readSize)
+        if not data:
+            raise ErrorCapture(self.name, 'process exited with status %s' % self.process.wait())
+        try:
+            return self.splitter.feed(data)
+        except Error as e:
+            raise ErrorCapture(self.name, e.msg)
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+        self.process = None
+
+
+class RaspistillBackend(ProcessBackend):
+    """ Keeps raspistill running in signal mode, where it takes a picture
+        every time it gets SIGUSR1 and writes it to its standard output.
+    """
+    name = 'raspistill'
+
+    def __init__(self, width=640, height=360, timeout=10):
+        args = ['raspistill', '-w', str(width), '-h', str(height), '-t', '0', '-s', '-n', '-th', 'none', '-o', '-']
+        ProcessBackend.__init__(self, args, timeout)
+        self.frames = []
+
+    def start(self):
+        ProcessBackend.start(self)
+        self.frames = []
+
+    def capture(self):
+        self.process.send_signal(signal.SIGUSR1)
+        deadline = time.time() + self.timeout
+        while not self.frames:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ErrorCapture(self.name, 'no frame within %s s' % self.timeout)
+            self.frames.extend(self.read(remaining))
+        return self.frames.pop(0)
+
+
+class PipeBackend(ProcessBackend):
+    """ Reads a motion JPEG stream that a process writes continuously, such
+        as raspivid -cd MJPEG -o - or this module run as a script. A reader
+        thread keeps the latest frame so the pipe never fills up, and capture
+        returns the first frame newer than the one it returned last.
+    """
+    name = 'pipe'
+
+    def __init__(self, args, timeout=10):
+        ProcessBackend.__init__(self, args, timeout)
+        self.cond = threading.Condition()
+        self.frame = None
+        self.frameNo = 0
+        self.lastNo = 0
+        self.error = None
+        self.reader = None
+
+    def start(self):
+        ProcessBackend.start(self)
+        self.error = None
+        self.reader = threading.Thread(target=self.readFrames)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def readFrames(self):
+        try:
+            while True:
+                frames = self.read(None)
+                if frames:
+                    with self.cond:
+                        self.frame = frames[-1]
+                        self.frameNo += len(frames)
+                        self.cond.notify_all()
+        except (Error, OSError, ValueError) as e:
+            with self.cond:
+                self.error = getattr(e, 'msg', str(e))
+                self.cond.notify_all()
+
+    def capture(self):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while self.frameNo == self.lastNo:
+                if self.error is not None:
+                    raise ErrorCapture(self.name, self.error)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ErrorCapture(self.name, 'no frame within %s s' % self.timeout)
+                self.cond.wait(remaining)
+            self.lastNo = self.frameNo
+            return self.frame
+
+    def stop(self):
+        ProcessBackend.stop(self)
+        if self.reader is not None:
+            self.reader.join(self.timeout)
+            self.reader = None
+
+
+BACKENDS = ['raspistill', 'pipe', 'synthetic']
+
+
+def openBackend(name, width=640, height=360, args=None):
+    """ Returns a new backend by name. args is the command line of the pipe
+        backend, which defaults to the synthetic stream of this module.
+    """
+    if name == 'raspistill':
+        return RaspistillBackend(width, height)
+    elif name == 'pipe':
+        if not args:
+            args = [sys.executable, os.path.abspath(__file__), '-W', str(width), '-H', str(height)]
+        return PipeBackend(args)
+    elif name == 'synthetic':
+        return SyntheticBackend(width, height)
+    raise Error('unknown camera backend %s' % name)
+
+
+class CaptureArgs(object):
+    """ Argument parser for the synthetic frame stream.
+    """
+    def __init__(self):
+        self.name = 'capture'
+        self.desc = 'Writes a stream of synthetic JPEG frames to standard output.'
+
+        self.rateHelp = 'Frames per second. Zero writes frames as fast as possible. Default is 10.'
+        self.framesHelp = 'Number of frames to write. Zero writes frames until killed.'
+        self.widthHelp = 'Width of the frames.'
+        self.heightHelp = 'Height of the frames.'
+
+        self.argParser = argparse.ArgumentParser(prog=self.name, description=self.desc)
+        self.argParser.add_argument('-r', '--rate', type=float, dest='rate', default=10, help=self.rateHelp)
+        self.argParser.add_argument('-n', '--frames', type=int, dest='frames', default=0, help=self.framesHelp)
+        self.argParser.add_argument('-W', '--width', type=int, dest='width', default=640, help=self.widthHelp)
+        self.argParser.add_argument('-H', '--height', type=int, dest='height', default=360, help=self.heightHelp)
+
+    def parse(self):
+        self.args = self.argParser.parse_args()
+
+
+def main():
+    args = CaptureArgs()
+    args.parse()
+    args = args.args
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    backend = SyntheticBackend(args.width, args.height)
+    count = 0
+    try:
+        while not args.frames or count < args.frames:
+            out.write(backend.capture())
+            out.flush()
+            count += 1
+            if args.rate > 0:
+                time.sleep(1.0 / args.rate)
+    except (IOError, KeyboardInterrupt):
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python2.7
+
+""" Configuration server of the feeders.
+
+Serves the control sessions of pifeedcontrol on the Twisted reactor, so a slow
+or stalled controller only holds on to its own connection instead of blocking
+every other one. Sessions that stay idle for too long are dropped. Requests
+and responses are framed as defined in the wire module.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import configstore
+import schedule
+import wire
+
+import collections
+
+from twisted.internet.defer import DeferredLock
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.protocols.basic import FileSender
+from twisted.protocols.policies import TimeoutMixin
+
+
+class Subscription(object):
+    """ Sensor readings pushed to a subscriber.
+
+        Readings wait in a bounded buffer that drops the oldest reading once
+        full and are sent in one batch every interval seconds, but only while
+        the subscriber has credit left. A subscriber that stops reading thus
+        costs at most a buffer of readings and a window of batches.
+    """
+    def __init__(self, protocol, subscriptionId, interval, window, maxBuffer):
+        self.protocol = protocol
+        self.subscriptionId = subscriptionId
+        self.credit = window
+        self.readings = collections.deque(maxlen=maxBuffer)
+        self.dropped = 0
+        self.loop = LoopingCall(self.flush)
+        self.loop.start(interval, now=False)
+
+    def add(self, reading):
+        if len(self.readings) == self.readings.maxlen:
+            self.dropped += 1
+        self.readings.append(reading)
+
+    def flush(self):
+        if not self.readings or self.credit <= 0:
+            return
+        self.credit -= 1
+        batch = {'readings': list(self.readings), 'dropped': self.dropped}
+        self.readings.clear()
+        self.dropped = 0
+        self.protocol.write(wire.encodeJson(wire.READINGS, self.subscriptionId, batch))
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+
+class ConfigProtocol(Protocol, TimeoutMixin):
+    """ Serves a control session. Requests are answered as soon as they
+        complete, tagged with their request ID, so a slow image read does not
+        hold up the answers to the requests behind it.
+
+        Images are streamed from their file by a FileSender instead of being
+        read into memory. Responses that are ready while an image is being
+        streamed wait in the outbox so they do not end up inside its frame.
+    """
+    def connectionMade(self):
+        self.peer = self.transport.getPeer()
+        self.decoder = wire.FrameDecoder(self.factory.maxSize)
+        self.outbox = collections.deque()
+        self.streaming = False
+        self.connected = True
+        self.subscriptions = {}
+        self.factory.clients += 1
+        self.setTimeout(self.factory.timeout)
+        if self.factory.verbosity >= 1:
+            print('%s: Connected to client %s:%s.' % (self.factory.feederName, self.peer.host, self.peer.port))
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        try:
+            frames = self.decoder.feed(data)
+        except wire.Error as e:
+            if self.factory.verbosity >= 1:
+                print('%s: Client %s:%s sent a bad frame: %s' % (self.factory.feederName, self.peer.host, self.peer.port, e.msg))
+            self.transport.abortConnection()
+            return
+
+        for (msgType, requestId, payload) in frames:
+            self.handle(msgType, requestId, payload)
+
+    def handle(self, msgType, requestId, payload):
+        """ Answers a single request.
+        """
+        if self.factory.verbosity >= 2:
+            print('%s: Received request %d of type %d from client %s:%s.' % (self.factory.feederName, requestId, msgType, self.peer.host, self.peer.port))
+
+        if msgType == wire.CONFIG:
+            try:
+                newConfig = wire.decodeJson(payload)
+            except wire.Error as e:
+                self.sendError(requestId, e.msg)
+                return
+
+            # Commit off the reactor thread, since it writes the configuration
+            # file, one request at a time in the order they arrived.
+            d = self.factory.commits.run(deferToThread, self.factory.commit, newConfig)
+            d.addCallback(self.committed, requestId)
+            d.addErrback(self.sendFailure, requestId)
+
+        elif msgType == wire.FEED:
+            d = self.factory.commits.run(deferToThread, self.factory.feed)
+            d.addCallback(self.committed, requestId)
+            d.addErrback(self.sendFailure, requestId)
+
+        elif msgType == wire.SENSOR:
+            self.write(wire.encodeJson(wire.SENSOR, requestId, self.factory.readSensor()))
+
+        elif msgType == wire.IMAGE:
+            try:
+                request = wire.decodeJson(payload) if payload else {}
+                offset = int(request.get('offset', 0))
+                crc = request.get('crc')
+            except (wire.Error, AttributeError, TypeError, ValueError):
+                self.sendError(requestId, 'not a valid image request')
+                return
+
+            # Open the image and get its checksum off the reactor thread.
+            d = deferToThread(self.factory.openImage, crc)
+            d.addCallback(self.sendImage, requestId, offset, crc)
+            d.addErrback(self.sendFailure, requestId)
+
+        elif msgType == wire.SUBSCRIBE:
+            try:
+                options = wire.decodeJson(payload)
+                interval = max(float(options.get('interval', 1)), self.factory.minInterval)
+                window = min(max(int(options.get('window', 4)), 1), self.factory.maxWindow)
+                maxBuffer = min(max(int(options.get('buffer', 64)), 1), self.factory.maxBuffer)
+            except (wire.Error, AttributeError, TypeError, ValueError):
+                self.sendError(requestId, 'not a valid subscription')
+                return
+            if requestId in self.subscriptions:
+                self.sendError(requestId, 'subscription %d already exists' % requestId)
+                return
+            self.write(wire.encodeJson(wire.ACK, requestId, {}))
+            self.subscriptions[requestId] = Subscription(self, requestId, interval, window, maxBuffer)
+            self.factory.subscriptions.add(self.subscriptions[requestId])
+
+        elif msgType == wire.CREDIT:
+            subscription = self.subscriptions.get(requestId)
+            if subscription is not None:
+                try:
+                    credit = int(wire.decodeJson(payload).get('credit', 1))
+                except (wire.Error, AttributeError, TypeError, ValueError):
+                    credit = 1
+                subscription.credit = min(subscription.credit + max(credit, 0), self.factory.maxWindow)
+
+        elif msgType == wire.UNSUBSCRIBE:
+            try:
+                subscriptionId = int(wire.decodeJson(payload)['id'])
+            except (wire.Error, KeyError, TypeError, ValueError):
+                self.sendError(requestId, 'not a valid subscription')
+                return
+            self.unsubscribe(subscriptionId)
+            self.write(wire.encodeJson(wire.ACK, requestId, {}))
+
+        else:
+            self.sendError(requestId, 'unknown message type %d' % msgType)
+
+    def unsubscribe(self, subscriptionId):
+        subscription = self.subscriptions.pop(subscriptionId, None)
+        if subscription is not None:
+            subscription.stop()
+            self.factory.subscriptions.discard(subscription)
+
+    def committed(self, error, requestId):
+        if error is None:
+            self.write(wire.encodeJson(wire.ACK, requestId, {}))
+        else:
+            self.sendError(requestId, error)
+
+    def sendImage(self, image, requestId, offset, crc):
+        """ Queues the image returned by openImage, starting at offset if the
+            client already has that much of the same image.
+        """
+        (f, size, imageCrc) = image
+        if not self.connected:
+            # The client left while the image was being opened.
+            f.close()
+            return
+        if crc != imageCrc or not 0 <= offset <= size:
+            offset = 0
+        f.seek(offset)
+        header = wire.HEADER.pack(wire.IMAGE, requestId, wire.IMAGE_HEADER.size + size - offset)
+        header += wire.IMAGE_HEADER.pack(size, offset, imageCrc)
+        self.outbox.append((header, f))
+        self.pump()
+
+    def sendFailure(self, failure, requestId):
+        self.sendError(requestId, failure.getErrorMessage())
+
+    def sendError(self, requestId, msg):
+        if self.factory.verbosity >= 1:
+            print('%s: Request from client %s:%s failed: %s' % (self.factory.feederName, self.peer.host, self.peer.port, msg))
+        self.write(wire.encode(wire.ERROR, requestId, msg.encode('utf-8')))
+
+    def write(self, data):
+        self.outbox.append(data)
+        self.pump()
+
+    def pump(self):
+        """ Writes out the outbox up to the next image, which is then
+            streamed.
+        """
+        while self.outbox and not self.streaming and self.connected:
+            item = self.outbox.popleft()
+            if isinstance(item, bytes):
+                self.transport.write(item)
+            else:
+                (header, f) = item
+                self.transport.write(header)
+                self.streaming = True
+                d = FileSender().beginFileTransfer(f, self.transport)
+                d.addBoth(self.streamDone, f)
+
+    def streamDone(self, result, f):
+        f.close()
+        self.streaming = False
+        self.pump()
+
+    def timeoutConnection(self):
+        # Subscribers may stay quiet for as long as the sensor is off.
+        if self.subscriptions:
+            self.resetTimeout()
+            return
+        if self.factory.verbosity >= 1:
+            print('%s: Client %s:%s timed out.' % (self.factory.feederName, self.peer.host, self.peer.port))
+        self.transport.abortConnection()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        self.factory.clients -= 1
+        self.connected = False
+        for subscriptionId in list(self.subscriptions):
+            self.unsubscribe(subscriptionId)
+        for item in self.outbox:
+            if not isinstance(item, bytes):
+                item[1].close()
+        self.outbox.clear()
+
+
+class ConfigFactory(Factory):
+    """ Builds a ConfigProtocol for every control connection and applies the
+        requests they receive to the feeder. openImage is called on a worker
+        thread with the CRC-32 of the image the client has part of and returns
+        the open file, the size and the CRC-32 of the JPEG to send.
+        readSensor returns the latest sensor reading. Readings handed to
+        publish are pushed to every subscriber. Configuration changes and
+        feeds are committed on a worker thread, one at a time.
+    """
+    protocol = ConfigProtocol
+
+    def __init__(self, verbosity, feederName, config, openImage, readSensor, timeout=300, maxSize=1024 * 1024):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.config = config
+        self.openImage = openImage
+        self.readSensor = readSensor
+        self.timeout = timeout
+        self.maxSize = maxSize
+        self.clients = 0
+        self.subscriptions = set()
+        self.commits = DeferredLock()
+        self.minInterval = 0.1
+        self.maxWindow = 64
+        self.maxBuffer = 1024
+
+    def commit(self, newConfig):
+        """ Merges a received configuration into the current one and commits
+            it, processing any manual feeding request. Returns None, or why
+            the configuration was rejected. Called on a worker thread.
+        """
+        # Hold the lock of the store from the read to the commit, so the
+        # feeder cannot commit in between and be undone.
+        with self.config.store.lock:
+            self.config.readConfig()
+            self.config.newConfig = newConfig
+            try:
+                if not self.config.processMan():
+                    return 'too many pending manual feeds'
+            except (AttributeError, KeyError, TypeError):
+                return 'not a valid configuration'
+            except (configstore.Error, schedule.Error) as e:
+                return e.msg
+        return None
+
+    def feed(self):
+        """ Queues a feed right away. Returns None, or why it was not queued.
+            Called on a worker thread.
+        """
+        with self.config.store.lock:
+            if not self.config.requestFeed():
+                return 'too many pending manual feeds'
+        return None
+
+    def publish(self, reading):
+        """ Queues a sensor reading for every subscriber. Must be called on
+            the reactor thread.
+        """
+        for subscription in self.subscriptions:
+            subscription.add(reading)
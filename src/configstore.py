@@ -0,0 +1,255 @@
+#!/usr/bin/env python2.7
+
+""" In-process store for the feeder configuration.
+
+The configuration file is parsed once when the store is loaded. Every commit
+writes the file, bumps the version number, and notifies subscribers, so the
+hardware threads can read an immutable snapshot instead of opening and parsing
+the file themselves. Edits made to the file outside of the process can be
+picked up with inotify.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import errno
+import json
+import os
+import struct
+import threading
+
+try:
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.inotify_init
+    libc.inotify_add_watch
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorConfig(Error):
+    """ Raised when a configuration is not valid.
+    """
+    def __init__(self, reason):
+        self.msg = 'error: invalid configuration: %s' % reason
+
+
+class Snapshot(dict):
+    """ Read-only dictionary handed out to readers of the store.
+    """
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('configuration snapshots are read-only')
+
+    __setitem__ = _readOnly
+    __delitem__ = _readOnly
+    clear = _readOnly
+    pop = _readOnly
+    popitem = _readOnly
+    setdefault = _readOnly
+    update = _readOnly
+
+
+def freeze(obj):
+    """ Returns a deep read-only copy of a parsed JSON object.
+    """
+    if isinstance(obj, dict):
+        return Snapshot((key, freeze(value)) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def thaw(obj):
+    """ Returns a deep mutable copy of a snapshot.
+    """
+    if isinstance(obj, dict):
+        return dict((key, thaw(value)) for (key, value) in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [thaw(value) for value in obj]
+    return obj
+
+
+class ConfigStore(object):
+    """ Versioned configuration shared by all the threads of a feeder.
+    """
+    def __init__(self, verbosity, feederName, configFile):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.configFile = configFile
+        self.lock = threading.RLock()
+        self.version = 0
+        self.snapshot = None
+        self.subscribers = []
+        self.watcher = None
+
+    def load(self, default=None):
+        """ Reads the configuration file from disk and publishes it. If there
+            is no configuration file yet, default is published instead when
+            it is given.
+        """
+        try:
+            with open(self.configFile, 'r') as f:
+                config = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT or default is None:
+                raise Error('cannot read from configuration file %s of feeder %s' % (self.configFile, self.feederName))
+            if self.verbosity >= 1:
+                print('%s: No configuration file %s yet, starting from the defaults.' % (self.feederName, self.configFile))
+            config = default
+        except ValueError:
+            raise Error('configuration file %s of feeder %s does not contain a valid JSON object' % (self.configFile, self.feederName))
+        self.commit(config, persist=False)
+
+    def get(self):
+        """ Returns the current snapshot without touching the disk.
+        """
+        return self.snapshot
+
+    def commit(self, config, persist=True):
+        """ Publishes a new configuration and optionally writes it to the
+            configuration file. Returns the new version number.
+        """
+        snapshot = freeze(config)
+        with self.lock:
+            if persist:
+                self._write(snapshot)
+            (version, subscribers) = self._publish(snapshot)
+        self._notify(subscribers, version, snapshot)
+        return version
+
+    def update(self, change):
+        """ Calls change with a mutable copy of the current configuration and
+            commits it, both under the lock, so no other commit can land in
+            between and be undone. Returns the new version number.
+        """
+        with self.lock:
+            config = thaw(self.snapshot)
+            change(config)
+            snapshot = freeze(config)
+            self._write(snapshot)
+            (version, subscribers) = self._publish(snapshot)
+        self._notify(subscribers, version, snapshot)
+        return version
+
+    def _publish(self, snapshot):
+        # Called with the lock held.
+        self.version += 1
+        self.snapshot = snapshot
+        return (self.version, list(self.subscribers))
+
+    def _notify(self, subscribers, version, snapshot):
+        for callback in subscribers:
+            callback(version, snapshot)
+
+    def subscribe(self, callback):
+        """ Registers callback(version, snapshot) to be called after every
+            commit.
+        """
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def watch(self):
+        """ Starts watching the configuration file for edits made outside of
+            the process. Returns False if inotify is not available.
+        """
+        if libc is None:
+            if self.verbosity >= 1:
+                print('%s: inotify is not available, not watching the configuration file.' % self.feederName)
+            return False
+        if self.watcher is None:
+            self.watcher = FileWatcher(self)
+            self.watcher.daemon = True
+            self.watcher.start()
+        return True
+
+    def reload(self):
+        """ Rereads the configuration file and commits it if it differs from
+            the current snapshot. The file is read under the lock, so a commit
+            can not land between the read and the compare and be rolled back
+            by an older version of the file.
+        """
+        with self.lock:
+            try:
+                with open(self.configFile, 'r') as f:
+                    config = json.load(f)
+            except (IOError, ValueError):
+                # The file is being rewritten or was removed, keep the
+                # snapshot.
+                return
+            snapshot = freeze(config)
+            if snapshot == self.snapshot:
+                return
+            if self.verbosity >= 1:
+                print('%s: Configuration file changed on disk.' % self.feederName)
+            (version, subscribers) = self._publish(snapshot)
+        self._notify(subscribers, version, snapshot)
+
+    def _write(self, config):
+        tmpFile = self.configFile + '.tmp'
+        try:
+            with open(tmpFile, 'w') as f:
+                json.dump(config, f)
+            os.rename(tmpFile, self.configFile)
+        except (IOError, OSError):
+            raise Error('cannot write to configuration file')
+        if self.verbosity >= 1:
+            print('%s: Successfuly updated configuration file.' % self.feederName)
+
+
+class FileWatcher(threading.Thread):
+    """ Watches the directory of the configuration file with inotify and
+        reloads the store when the file is written or replaced.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    eventHeader = struct.Struct('iIII')
+
+    def __init__(self, store):
+        threading.Thread.__init__(self)
+        self.store = store
+        self.dirName = os.path.dirname(os.path.abspath(store.configFile))
+        self.baseName = os.path.basename(store.configFile)
+
+    def run(self):
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise Error('inotify_init failed: %s' % os.strerror(ctypes.get_errno()))
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO
+        if libc.inotify_add_watch(fd, self.dirName.encode('utf-8'), mask) < 0:
+            raise Error('inotify_add_watch failed: %s' % os.strerror(ctypes.get_errno()))
+
+        while True:
+            try:
+                buf = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if self._touched(buf):
+                self.store.reload()
+
+    def _touched(self, buf):
+        """ Returns True if any event in buf refers to the configuration file.
+        """
+        offset = 0
+        while offset + self.eventHeader.size <= len(buf):
+            (wd, mask, cookie, length) = self.eventHeader.unpack_from(buf, offset)
+            offset += self.eventHeader.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if name == self.baseName:
+                return True
+        return False
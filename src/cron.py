@@ -0,0 +1,195 @@
+#!/usr/bin/env python2.7
+
+""" Cron-style schedule expressions for the feeders.
+
+Expressions are compiled once into a schedule.WeekIndex, so finding the next
+feed is a binary search over minute-of-week offsets no matter how the
+expression was written. These forms are understood:
+
+    every 90 minutes between 07:00 and 21:00 on weekdays
+    every 4h on SAT,SUN
+    at 08:00,18:30 on MON-FRI
+    30 7-21/2 * * 1-5
+
+The last one is a five-field cron line. Only weekly schedules can be expressed,
+so its day of month and month fields must be '*'.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import re
+
+import schedule
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorExpression(Error):
+    """ Raised when a schedule expression cannot be parsed.
+    """
+    def __init__(self, expr, reason):
+        self.msg = 'error: invalid schedule expression "%s": %s' % (expr, reason)
+
+
+ALL_DAYS = list(range(7))
+
+DAY_ALIASES = {
+    'ALL': ALL_DAYS,
+    'DAILY': ALL_DAYS,
+    'WEEKDAYS': ALL_DAYS[:5],
+    'WEEKENDS': ALL_DAYS[5:]
+}
+
+UNITS = {
+    'm': 1,
+    'min': 1,
+    'mins': 1,
+    'minute': 1,
+    'minutes': 1,
+    'h': 60,
+    'hr': 60,
+    'hrs': 60,
+    'hour': 60,
+    'hours': 60
+}
+
+everyRe = re.compile(r'^every\s+(\d+)\s*([a-z]+)'
+                     r'(?:\s+(?:between|from)\s+(\d{1,2}:\d{2})\s+(?:and|to)\s+(\d{1,2}:\d{2}))?'
+                     r'(?:\s+on\s+(.+))?$')
+atRe = re.compile(r'^at\s+(\d{1,2}:\d{2}(?:\s*,\s*\d{1,2}:\d{2})*)(?:\s+on\s+(.+))?$')
+
+
+def parseTime(expr, text):
+    """ Returns the minute of the day of an 'HH:MM' string.
+    """
+    (hour, minute) = [int(part) for part in text.split(':')]
+    if hour > 23 or minute > 59:
+        raise ErrorExpression(expr, 'bad time %s' % text)
+    return hour * 60 + minute
+
+
+def parseDays(expr, text):
+    """ Returns the sorted days of the week named by text, which is a list of
+        day names, ranges such as MON-FRI, and aliases such as weekdays.
+    """
+    if text is None:
+        return ALL_DAYS
+    days = set()
+    for token in re.split(r'[\s,]+', text.strip().upper()):
+        if token in DAY_ALIASES:
+            days.update(DAY_ALIASES[token])
+        elif '-' in token:
+            (first, last) = token.split('-', 1)
+            if first not in schedule.DAYS_OF_WEEK or last not in schedule.DAYS_OF_WEEK:
+                raise ErrorExpression(expr, 'bad day range %s' % token)
+            day = schedule.DAYS_OF_WEEK[first]
+            days.add(day)
+            while day != schedule.DAYS_OF_WEEK[last]:
+                day = (day + 1) % 7
+                days.add(day)
+        elif token in schedule.DAYS_OF_WEEK:
+            days.add(schedule.DAYS_OF_WEEK[token])
+        else:
+            raise ErrorExpression(expr, 'bad day %s' % token)
+    return sorted(days)
+
+
+def parseField(expr, text, low, high):
+    """ Returns the values of a cron field, which is a list of '*', single
+        values, and ranges, each with an optional '/step'. As in cron, a
+        single value with a step, such as 5/20, runs to the end of the range.
+    """
+    values = set()
+    for part in text.split(','):
+        step = None
+        if '/' in part:
+            (part, stepText) = part.split('/', 1)
+            step = int(stepText)
+            if step < 1:
+                raise ErrorExpression(expr, 'bad step in %s' % text)
+        if part == '*':
+            (first, last) = (low, high)
+        elif '-' in part:
+            (first, last) = [int(value) for value in part.split('-', 1)]
+        else:
+            first = last = int(part)
+            if step is not None:
+                last = high
+        if first < low or last > high or first > last:
+            raise ErrorExpression(expr, 'field %s out of range %d-%d' % (text, low, high))
+        values.update(range(first, last + 1, step or 1))
+    return sorted(values)
+
+
+def compileEvery(expr, match):
+    (count, unit, start, end, days) = match.groups()
+    if unit not in UNITS:
+        raise ErrorExpression(expr, 'bad unit %s' % unit)
+    interval = int(count) * UNITS[unit]
+    if interval < 1:
+        raise ErrorExpression(expr, 'interval must be positive')
+
+    if start is None:
+        (first, last) = (0, schedule.MINUTES_PER_DAY - 1)
+    else:
+        first = parseTime(expr, start)
+        last = parseTime(expr, end)
+        # Windows such as 22:00 to 02:00 run past midnight.
+        if last < first:
+            last += schedule.MINUTES_PER_DAY
+
+    minutes = range(first, last + 1, interval)
+    return offsets(parseDays(expr, days), minutes)
+
+
+def compileAt(expr, match):
+    (times, days) = match.groups()
+    minutes = [parseTime(expr, text.strip()) for text in times.split(',')]
+    return offsets(parseDays(expr, days), minutes)
+
+
+def compileCron(expr, fields):
+    (minuteField, hourField, domField, monthField, dowField) = fields
+    if domField != '*' or monthField != '*':
+        raise ErrorExpression(expr, 'only weekly schedules are supported')
+    minutes = parseField(expr, minuteField, 0, 59)
+    hours = parseField(expr, hourField, 0, 23)
+
+    # Cron counts days from Sunday and allows 7 for Sunday as well.
+    for (name, day) in schedule.DAYS_OF_WEEK.items():
+        dowField = dowField.replace(name, str((day + 1) % 7))
+    days = sorted(set((day - 1) % 7 for day in parseField(expr, dowField, 0, 7)))
+    return offsets(days, [hour * 60 + minute for hour in hours for minute in minutes])
+
+
+def offsets(days, minutes):
+    """ Returns the minute-of-week offsets of the minutes of the day on each
+        of the days.
+    """
+    return [(day * schedule.MINUTES_PER_DAY + minute) % schedule.MINUTES_PER_WEEK for day in days for minute in minutes]
+
+
+def compileExpr(expr):
+    """ Compiles a schedule expression into a schedule.WeekIndex.
+    """
+    text = ' '.join(expr.strip().split())
+    lowered = text.lower()
+    try:
+        match = everyRe.match(lowered)
+        if match:
+            return schedule.WeekIndex(compileEvery(expr, match))
+        match = atRe.match(lowered)
+        if match:
+            return schedule.WeekIndex(compileAt(expr, match))
+        fields = text.upper().split(' ')
+        if len(fields) == 5:
+            return schedule.WeekIndex(compileCron(expr, fields))
+    except ValueError as e:
+        raise ErrorExpression(expr, str(e))
+    raise ErrorExpression(expr, 'not an every, at or cron expression')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python2.7
+
+""" Fleet of feeders.
+
+Reads the inventory of feeders and runs a request against many of them at
+once on a bounded pool of worker threads, so a fleet-wide change takes about
+one round trip instead of one per feeder. The result and the latency of every
+feeder are collected.
+
+The inventory is a JSON file mapping feeder names to their address:
+
+    {"RASPF1": {"host": "10.0.0.11", "port": 8080},
+     "RASPC1": {"host": "10.0.0.12", "port": 8080}}
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import collections
+import json
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorInventory(Error):
+    """ Raised when the inventory cannot be read.
+    """
+    def __init__(self, path, reason):
+        self.msg = 'error: bad inventory %s: %s' % (path, reason)
+
+
+Feeder = collections.namedtuple('Feeder', ['name', 'host', 'port'])
+
+# The value returned for the feeder, or the error message if it failed, and
+# the latency in seconds.
+Result = collections.namedtuple('Result', ['feeder', 'value', 'error', 'latency'])
+
+
+def loadInventory(path):
+    """ Returns an ordered dictionary mapping the feeder names of the
+        inventory file at path to their Feeder.
+    """
+    try:
+        with open(path, 'r') as f:
+            entries = json.load(f, object_pairs_hook=collections.OrderedDict)
+    except IOError as e:
+        raise ErrorInventory(path, e.strerror)
+    except ValueError as e:
+        raise ErrorInventory(path, e)
+    if not isinstance(entries, dict):
+        raise ErrorInventory(path, 'expected an object of feeders')
+
+    inventory = collections.OrderedDict()
+    for (name, entry) in entries.items():
+        try:
+            inventory[name] = Feeder(name, str(entry['host']), int(entry['port']))
+        except (KeyError, TypeError, ValueError):
+            raise ErrorInventory(path, 'feeder %s needs a host and a port' % name)
+    return inventory
+
+
+class FanOut(object):
+    """ Runs a call against many feeders with at most maxWorkers of them in
+        flight at once.
+    """
+    def __init__(self, verbosity, maxWorkers=32):
+        self.verbosity = verbosity
+        self.maxWorkers = maxWorkers
+
+    def run(self, feeders, call):
+        """ Calls call(feeder) for every Feeder in feeders and returns a list
+            of Results in the same order. Errors are recorded in the Result of
+            their feeder instead of being raised.
+        """
+        work = queue.Queue()
+        for (i, feeder) in enumerate(feeders):
+            work.put((i, feeder))
+        results = [None] * len(feeders)
+
+        def worker():
+            while True:
+                try:
+                    (i, feeder) = work.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    results[i] = Result(feeder, call(feeder), None, time.time() - start)
+                except Exception as e:
+                    results[i] = Result(feeder, None, getattr(e, 'msg', str(e)), time.time() - start)
+                if self.verbosity >= 2:
+                    print('%s: Finished in %.1f ms.' % (feeder.name, results[i].latency * 1e3))
+
+        threads = [threading.Thread(target=worker) for i in range(min(self.maxWorkers, len(feeders)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
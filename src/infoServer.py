@@ -1,43 +1,556 @@
 #!/usr/bin/env python2.7
 
-""" Controls, configures, and monitors pet feeders.
+""" Info server of the feeders.
 
-An application that receives connection requests from the PiFeed control
-or PiFeed feeders and sends an image retrieved from the Raspberry Pi
-camera to the Twisted web server.
+Serves the info page and the files next to it on the Twisted reactor. The
+camera image is served from the frame ring in memory, so frames never have to
+go through the SD card to reach the page, and a motion JPEG stream of the
+frames is served at /stream.mjpg. Both take ?size=NAME to get one of the
+smaller renditions the ring keeps of every frame, such as ?size=thumb. With
+a time-lapse archive, /lapse.jpg?at=TIME serves the archived frame nearest to
+TIME, given in seconds since the epoch. /api/status serves the state of the
+feeder as JSON from memory, and /api/events pushes every change of it to the
+client as Server-Sent Events as it happens. A server can serve any number of
+feeders, each under /feeders/NAME/ with image.jpg, stream.mjpg, lapse.jpg and
+api/, and the first one also at the paths above.
+
+Every response carries a strong ETag, from the checksum of a frame or the
+modification time and size of a file, and the Last-Modified time, and is
+answered with 304 Not Modified when the client already has it. Text files are
+gzip-encoded for clients that accept it, compressed once per version of the
+file.
+
+Run as a script, serves the page with synthetic camera frames.
 """
 
 __author__ = 'Danny Duangphachanh, Igor Janjic, Daniel Friedman'
 
-import threading
-from twisted.web import resource
+import collections
+import json
+import os
+import time
+import zlib
+
+import capture
+
 from twisted.internet import reactor
-from twisted.web.server import Site
-from twisted.web.static import File
+from twisted.internet.task import LoopingCall
 from twisted.internet.threads import deferToThread
+from twisted.web import http, resource
+from twisted.web.server import NOT_DONE_YET, Site
+from twisted.web.static import File, getTypeAndEncoding
+
+# Content types that are gzip-encoded.
+COMPRESSIBLE = ['application/javascript', 'application/json', 'image/svg+xml']
+
+
+def isCached(request, etag, when):
+    """ Sets the ETag and Last-Modified headers of a response and returns True
+        if the client already has it, in which case the response is 304 Not
+        Modified and has no body. If-Modified-Since only has a resolution of
+        a second, so it is only used without If-None-Match.
+    """
+    if request.setETag(etag) is http.CACHED:
+        return True
+    if request.getHeader(b'if-none-match'):
+        request.setHeader(b'last-modified', http.datetimeToString(when))
+        return False
+    return request.setLastModified(when) is http.CACHED
+
+
+def acceptsGzip(request):
+    request.setHeader(b'vary', b'accept-encoding')
+    return b'gzip' in (request.getHeader(b'accept-encoding') or b'')
+
+
+def gzipped(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class InfoFile(File):
+    """ File with a strong ETag, caching tuned to its type, and text
+        gzip-encoded. Pages are revalidated on every load, and style sheets,
+        scripts and images are cached for a while.
+    """
+    # Compressed files by path, with the modification time and size they
+    # were compressed at.
+    compressed = {}
+
+    def render_GET(self, request):
+        self.restat(False)
+        if not self.exists() or self.isdir():
+            return File.render_GET(self, request)
+        (contentType, encoding) = getTypeAndEncoding(self.basename(), self.contentTypes, self.contentEncodings, self.defaultType)
+        when = self.getModificationTime()
+        size = self.getsize()
+        gzip = encoding is None and (contentType.startswith('text/') or contentType in COMPRESSIBLE) and acceptsGzip(request)
+
+        if contentType == 'text/html':
+            request.setHeader(b'cache-control', b'no-cache')
+        else:
+            request.setHeader(b'cache-control', b'max-age=3600')
+        etag = '"%x-%x%s"' % (int(when * 1e6), size, '-gz' if gzip else '')
+        if isCached(request, etag.encode('ascii'), when):
+            return b''
+
+        # File.render_GET checks If-Modified-Since again, which must not
+        # answer 304 when If-None-Match did not match.
+        request.requestHeaders.removeHeader(b'if-modified-since')
+        if not gzip:
+            return File.render_GET(self, request)
+
+        path = self.path
+        entry = self.compressed.get(path)
+        if entry is None or entry[:2] != (when, size):
+            try:
+                with open(path, 'rb') as f:
+                    entry = (when, size, gzipped(f.read()))
+            except IOError:
+                return File.render_GET(self, request)
+            self.compressed[path] = entry
+        request.setHeader(b'content-type', contentType.encode('ascii'))
+        request.setHeader(b'content-encoding', b'gzip')
+        request.setHeader(b'content-length', str(len(entry[2])).encode('ascii'))
+        if request.method == b'HEAD':
+            return b''
+        return entry[2]
+
+    render_HEAD = render_GET
+
+
+def getSize(request, ring):
+    """ Returns the rendition named by ?size=NAME of the request, or None for
+        the full frame. Raises KeyError if the ring has no such rendition.
+    """
+    size = request.args.get(b'size')
+    if not size or size[0] in (b'', b'full'):
+        return None
+    name = size[0].decode('ascii', 'replace')
+    if name not in ring.sizes:
+        raise KeyError(name)
+    return name
+
+
+def badSize(request, ring):
+    """ Answers a request for a rendition the ring does not have.
+    """
+    request.setResponseCode(400)
+    return ('size is one of full, %s' % ', '.join(ring.sizes)).encode('ascii')
+
+
+class FrameResource(resource.Resource):
+    """ Serves the latest frame of the ring, or the frame given by ?seq=N
+        while it is still in the ring, scaled to the rendition given by
+        ?size=NAME. Serves the archived image on disk until the first frame
+        is captured. The latest frame is revalidated on every poll, and a
+        buffered frame by sequence number is cached for a while.
+    """
+    isLeaf = True
+
+    def __init__(self, ring, imageFile):
+        resource.Resource.__init__(self)
+        self.ring = ring
+        self.imageFile = imageFile
+
+    def render_GET(self, request):
+        try:
+            size = getSize(request, self.ring)
+        except KeyError:
+            return badSize(request, self.ring)
+        seq = request.args.get(b'seq')
+        if seq:
+            try:
+                frame = self.ring.get(int(seq[0]))
+            except ValueError:
+                frame = None
+            if frame is None:
+                request.setResponseCode(404)
+                return b'frame is not buffered'
+            request.setHeader(b'cache-control', b'max-age=60')
+        else:
+            frame = self.ring.latest()
+            if frame is None:
+                return InfoFile(self.imageFile, defaultType='image/jpeg').render(request)
+            request.setHeader(b'cache-control', b'no-cache')
+
+        request.setHeader(b'content-type', b'image/jpeg')
+        request.setHeader(b'x-frame-seq', str(frame.seq).encode('ascii'))
+        etag = '"%08x-%s"' % (frame.crc(), size or 'full')
+        if isCached(request, etag.encode('ascii'), frame.when):
+            return b''
+        return frame.rendition(size)
+
+
+class Viewer(object):
+    """ A viewer of the motion JPEG stream.
+
+        The viewer is registered as the producer of its request, so the
+        transport pauses it while the frames written so far have not been
+        sent yet. Frames offered while it is paused replace each other and
+        only the newest is sent once it resumes, so a slow viewer drops frames
+        instead of buffering them.
+    """
+    def __init__(self, request, boundary, size=None):
+        self.request = request
+        self.boundary = boundary
+        self.size = size
+        self.paused = False
+        self.pending = None
+        self.sent = 0
+        self.dropped = 0
+        request.registerProducer(self, True)
+
+    def offer(self, frame):
+        if not self.paused:
+            self.write(frame)
+            return
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = frame
+
+    def write(self, frame):
+        data = frame.rendition(self.size)
+        self.request.write(b'--' + self.boundary + b'\r\nContent-Type: image/jpeg\r\nContent-Length: ' +
+                           str(len(data)).encode('ascii') + b'\r\n\r\n')
+        self.request.write(data)
+        self.request.write(b'\r\n')
+        self.sent += 1
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.pending is not None:
+            (frame, self.pending) = (self.pending, None)
+            self.write(frame)
+
+    def stopProducing(self):
+        self.paused = True
+        self.pending = None
+
+
+class StreamResource(resource.Resource):
+    """ Serves the frames as a multipart/x-mixed-replace motion JPEG stream.
+        Every frame is captured and scaled once and handed to all viewers.
+    """
+    isLeaf = True
+    boundary = b'pifeedframe'
 
+    def __init__(self, ring):
+        resource.Resource.__init__(self)
+        self.ring = ring
+        self.viewers = set()
+        ring.addListener(self.frameCaptured)
 
-class InfoServer(threading.Thread):
+    def frameCaptured(self, frame):
+        # Called on the camera thread.
+        reactor.callFromThread(self.publish, frame)
+
+    def publish(self, frame):
+        for viewer in list(self.viewers):
+            viewer.offer(frame)
+
+    def render_GET(self, request):
+        try:
+            size = getSize(request, self.ring)
+        except KeyError:
+            return badSize(request, self.ring)
+        request.setHeader(b'content-type', b'multipart/x-mixed-replace; boundary=' + self.boundary)
+        request.setHeader(b'cache-control', b'no-cache')
+        viewer = Viewer(request, self.boundary, size)
+        self.viewers.add(viewer)
+        request.notifyFinish().addBoth(self.viewerGone, viewer)
+
+        # Start with the latest frame instead of waiting for the next one.
+        frame = self.ring.latest()
+        if frame is not None:
+            viewer.offer(frame)
+        return NOT_DONE_YET
+
+    def viewerGone(self, result, viewer):
+        self.viewers.discard(viewer)
+
+
+class LapseResource(resource.Resource):
+    """ Serves the frame of the time-lapse archive nearest to ?at=TIME, or to
+        now, read from disk on a worker thread. Frames are only appended
+        after the newest one, so once the nearest frame is not older than
+        TIME it stays the nearest and can be cached.
+    """
+    isLeaf = True
+
+    def __init__(self, archive):
+        resource.Resource.__init__(self)
+        self.archive = archive
+
+    def render_GET(self, request):
+        at = request.args.get(b'at')
+        try:
+            when = float(at[0]) if at else time.time()
+        except ValueError:
+            request.setResponseCode(400)
+            return b'at is seconds since the epoch'
+        gone = []
+        request.notifyFinish().addErrback(gone.append)
+        d = deferToThread(self.archive.nearest, when)
+        d.addCallback(self.sendFrame, request, when, gone)
+        d.addErrback(self.sendError, request, gone)
+        return NOT_DONE_YET
+
+    def sendFrame(self, frame, request, when, gone):
+        if gone:
+            return
+        if frame is None:
+            request.setResponseCode(404)
+            request.write(b'time-lapse is empty')
+        else:
+            (taken, data) = frame
+            request.setHeader(b'content-type', b'image/jpeg')
+            request.setHeader(b'x-frame-time', ('%.3f' % taken).encode('ascii'))
+            if request.args.get(b'at') and taken >= when:
+                request.setHeader(b'cache-control', b'max-age=86400')
+            else:
+                request.setHeader(b'cache-control', b'no-cache')
+            if not isCached(request, ('"lapse-%.3f-%x"' % (taken, len(data))).encode('ascii'), taken):
+                request.write(data)
+        request.finish()
+
+    def sendError(self, failure, request, gone):
+        if gone:
+            return
+        request.setResponseCode(500)
+        request.write(b'cannot read the time-lapse')
+        request.finish()
+
+
+class Status(object):
+    """ State of a feeder for the status API: its configuration, next and
+        last feed, latest sensor reading and latest frame. The state is only
+        changed on the reactor thread, and the JSON body is serialized and
+        compressed once per change, by the first request after it. Every
+        change is an event, such as feed or frame, and is handed to the
+        listeners with the part of the state that changed.
+    """
+    def __init__(self, feederName):
+        self.state = {'feeder': feederName, 'config': None, 'nextFeed': None, 'lastFeed': None, 'sensor': None, 'frame': None}
+        self.started = int(time.time())
+        self.changed = time.time()
+        self.version = 0
+        self.body = None
+        self.listeners = []
+
+    def addListener(self, listener):
+        """ Calls listener(event, state) with every change from now on, on
+            the reactor thread.
+        """
+        self.listeners.append(listener)
+
+    def update(self, event, **state):
+        self.state.update(state)
+        self.changed = time.time()
+        self.version += 1
+        self.body = None
+        for listener in self.listeners:
+            listener(event, state)
+
+    def updateFromThread(self, event, **state):
+        """ Updates the state from any thread.
+        """
+        reactor.callFromThread(self.update, event, **state)
+
+    def frameCaptured(self, frame):
+        self.updateFromThread('frame', frame={'seq': frame.seq, 'time': frame.when})
+
+    def render(self):
+        """ Returns the ETag, the JSON body and the body gzip-encoded, or None
+            if it is too small to bother.
+        """
+        if self.body is None:
+            data = json.dumps(self.state, sort_keys=True).encode('utf-8')
+            etag = '"%x-%x"' % (self.started, self.version)
+            self.body = (etag.encode('ascii'), data, gzipped(data) if len(data) >= 256 else None)
+        return self.body
+
+
+class StatusResource(resource.Resource):
+    """ Serves the Status of the feeder as JSON.
+    """
+    isLeaf = True
+
+    def __init__(self, status):
+        resource.Resource.__init__(self)
+        self.status = status
+
+    def render_GET(self, request):
+        (etag, data, compressed) = self.status.render()
+        request.setHeader(b'content-type', b'application/json')
+        request.setHeader(b'cache-control', b'no-cache')
+        gzip = acceptsGzip(request) and compressed is not None
+        if gzip:
+            # The compressed body is a different representation.
+            etag = etag[:-1] + b'-gz"'
+        if isCached(request, etag, self.status.changed):
+            return b''
+        if gzip:
+            request.setHeader(b'content-encoding', b'gzip')
+            return compressed
+        return data
+
+
+class EventClient(object):
+    """ A client of the event stream.
+
+        Like a Viewer, the client is the producer of its request and is
+        paused while the events written so far have not been sent. Events
+        offered while it is paused are coalesced, keeping only the newest
+        event of each type, so a slow client gets the current state once it
+        catches up instead of a backlog.
+    """
+    def __init__(self, request):
+        self.request = request
+        self.paused = False
+        self.pending = collections.OrderedDict()
+        self.sent = 0
+        self.coalesced = 0
+        request.registerProducer(self, True)
+
+    def offer(self, event, data):
+        if not self.paused:
+            self.request.write(data)
+            self.sent += 1
+            return
+        if event in self.pending:
+            # Move the event behind the ones that happened before it.
+            del self.pending[event]
+            self.coalesced += 1
+        self.pending[event] = data
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self.pending and not self.paused:
+            (event, data) = self.pending.popitem(last=False)
+            self.request.write(data)
+            self.sent += 1
+
+    def stopProducing(self):
+        self.paused = True
+        self.pending.clear()
+
+
+class EventResource(resource.Resource):
+    """ Pushes the changes of the Status to the clients as Server-Sent
+        Events, each written once and handed to all clients. A client first
+        gets the whole state as a status event, then an event with the part
+        of the state that changed for every change. A comment is sent every
+        keepAlive seconds so idle connections are not dropped.
     """
+    isLeaf = True
+
+    def __init__(self, status, keepAlive=15):
+        resource.Resource.__init__(self)
+        self.status = status
+        self.clients = set()
+        status.addListener(self.publish)
+        self.keepAlive = LoopingCall(self.publishData, 'keepalive', b': keepalive\n\n')
+        self.keepAlive.start(keepAlive, now=False)
+
+    def encode(self, event, state):
+        return ('id: %d\nevent: %s\ndata: %s\n\n' % (self.status.version, event, json.dumps(state, sort_keys=True))).encode('utf-8')
+
+    def publish(self, event, state):
+        if self.clients:
+            self.publishData(event, self.encode(event, state))
+
+    def publishData(self, event, data):
+        for client in list(self.clients):
+            client.offer(event, data)
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/event-stream')
+        request.setHeader(b'cache-control', b'no-cache')
+        client = EventClient(request)
+        self.clients.add(client)
+        request.notifyFinish().addBoth(self.clientGone, client)
+        client.offer('status', b'retry: 2000\n' + self.encode('status', self.status.state))
+        return NOT_DONE_YET
+
+    def clientGone(self, result, client):
+        self.clients.discard(client)
+
+
+class InfoServer(object):
+    """ Web server with the info page of the feeders. The files under root
+        are served from disk, except for the camera images of the feeders.
+        Every feeder is served under /feeders/NAME/, and the first one is
+        also served at the paths of a server with a single feeder.
     """
-    def __init__(self, feederName, lockCamera, lockSensor):
-        threading.Thread.__init__(self)
-        feederName = feederName
-        res = File('/home/pi/PiFeed/src/')
-        res.putChild('', res)
-        factory = Site(res)
-        reactor.listenTCP(8000, factory)
-        print('%s: twisted web server started' % (feederName))
+    def __init__(self, verbosity, root):
+        self.verbosity = verbosity
+        self.rootDir = root
+        self.root = InfoFile(root)
+        self.root.putChild(b'', self.root)
+        self.feeders = resource.Resource()
+        self.root.putChild(b'feeders', self.feeders)
+        self.imageDirs = {}
+        self.feederNames = []
+
+    def addFeeder(self, feederName, ring, imageFile, lapse=None, status=None):
+        """ Serves the frames of ring as the camera image imageFile, which is
+            relative to root, and as image.jpg and stream.mjpg of the feeder.
+            The time-lapse archive lapse and the Status status are optional.
+        """
+        frames = FrameResource(ring, imageFile)
+        stream = StreamResource(ring)
+        feeder = resource.Resource()
+        feeder.putChild(b'image.jpg', frames)
+        feeder.putChild(b'stream.mjpg', stream)
+        children = [(b'stream.mjpg', stream)]
+        if lapse is not None:
+            children.append((b'lapse.jpg', LapseResource(lapse)))
+        if status is not None:
+            api = resource.Resource()
+            api.putChild(b'status', StatusResource(status))
+            api.putChild(b'events', EventResource(status))
+            children.append((b'api', api))
+        for (name, child) in children:
+            feeder.putChild(name, child)
+        self.feeders.putChild(feederName.encode('ascii'), feeder)
+
+        # Feeders share the image directory, each with its own image in it.
+        (imageDir, imageName) = os.path.split(imageFile)
+        images = self.imageDirs.get(imageDir)
+        if images is None:
+            images = InfoFile(os.path.join(self.rootDir, imageDir))
+            self.imageDirs[imageDir] = images
+            self.root.putChild(imageDir.encode('ascii'), images)
+        if imageName.encode('ascii') not in images.children:
+            images.putChild(imageName.encode('ascii'), frames)
+        if not self.feederNames:
+            for (name, child) in children:
+                self.root.putChild(name, child)
+        self.feederNames.append(feederName)
 
-    def run(self):
-        reactor.run()
+    def listen(self, port):
+        reactor.listenTCP(port, Site(self.root))
+        if self.verbosity >= 1:
+            print('%s: twisted web server started' % ', '.join(self.feederNames))
 
 
 def main():
-    lockCamera = threading.Lock()
-    lockSensor = threading.Lock()
-    infoServer = InfoServer('RASPF1', lockCamera, lockSensor)
-    #infoServer.start()
+    ring = capture.FrameRing(16, capture.SIZES)
+    status = Status('RASPF1')
+    ring.addListener(status.frameCaptured)
+    backend = capture.SyntheticBackend()
+    LoopingCall(lambda: ring.push(backend.capture())).start(0.2)
+    infoServer = InfoServer(1, os.path.dirname(os.path.abspath(__file__)))
+    infoServer.addFeeder('RASPF1', ring, '_img/Fish.jpg', status=status)
+    infoServer.listen(8000)
+    reactor.run()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python2.7
+
+""" Motion detection for the feeder cameras.
+
+Frames are compared on a small grayscale thumbnail, decoded at a reduced scale
+straight from the JPEG, so a frame costs a fraction of a millisecond to check.
+Frames that did not change are not kept, and the camera waits longer and
+longer between frames while nothing moves and goes back to its full rate as
+soon as something does.
+
+NumPy and PIL are optional. Without them every frame counts as changed and
+the camera captures at its configured rate.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import io
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def available():
+    """ Returns True if NumPy and PIL are installed.
+    """
+    return numpy is not None and Image is not None
+
+
+class MotionDetector(object):
+    """ Detects change between frames. A pixel of the thumbnail changed if
+        its brightness moved by more than threshold levels, and a frame
+        changed if more than fraction of the pixels did. Frames are compared
+        with the last frame that changed, so slow drift adds up until it
+        counts as a change.
+    """
+    def __init__(self, size=(80, 45), threshold=12, fraction=0.005):
+        self.size = size
+        self.threshold = threshold
+        self.fraction = fraction
+        self.reference = None
+
+    def thumbnail(self, data):
+        """ Returns the grayscale thumbnail of a JPEG frame as an array.
+        """
+        image = Image.open(io.BytesIO(data))
+        # Let the JPEG decoder do most of the downsampling.
+        image.draft('L', (self.size[0] * 2, self.size[1] * 2))
+        image = image.convert('L').resize(self.size)
+        return numpy.asarray(image, dtype=numpy.int16)
+
+    def check(self, data):
+        """ Returns whether a JPEG frame changed and the fraction of its
+            pixels that did.
+        """
+        if not available():
+            return (True, 1.0)
+        try:
+            current = self.thumbnail(data)
+        except (IOError, ValueError):
+            # Keep frames that cannot be decoded rather than lose them.
+            return (True, 1.0)
+        if self.reference is None or self.reference.shape != current.shape:
+            self.reference = current
+            return (True, 1.0)
+
+        score = float(numpy.count_nonzero(numpy.abs(current - self.reference) > self.threshold)) / current.size
+        changed = score >= self.fraction
+        if changed:
+            self.reference = current
+        return (changed, score)
+
+
+class AdaptiveRate(object):
+    """ Interval between captures. Grows by backoff with every frame that did
+        not change, up to maxInterval, and drops back to the shortest interval
+        with the first frame that did.
+    """
+    def __init__(self, maxInterval, backoff=1.5):
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.idle = 0
+
+    def update(self, changed):
+        if changed:
+            self.idle = 0
+        else:
+            self.idle += 1
+
+    def interval(self, minInterval):
+        """ Returns the interval to wait before the next capture, where
+            minInterval is the interval at the configured camera rate.
+        """
+        if self.maxInterval <= minInterval:
+            return minInterval
+        interval = minInterval
+        for i in range(self.idle):
+            interval *= self.backoff
+            if interval >= self.maxInterval:
+                return self.maxInterval
+        return interval
@@ -0,0 +1,1067 @@
+#!/usr/bin/env python2.7
+
+""" Feeder daemon.
+
+Hosts any number of feeders in one process. Every feeder has its own
+configuration, schedule, camera and image, sensor and config server port, and
+they all share the reactor, its timers and worker threads, and one info
+server. What kind of feeder a feeder is, and so which actuator moves its food,
+comes from the species registry, so pifeedfish and pifeedcat are this daemon
+hosting one feeder of their species.
+
+    pifeed.py -i 0.0.0.0 -p 8080 -f RASPF1 RASPC1:cat:9090
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import capture
+import configserver
+import configstore
+import cron
+import infoServer
+import motion
+import schedule
+import timelapse
+
+import argparse
+import datetime
+import io
+import json
+import numbers
+import os
+import re
+import zlib
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.error import CannotListenError
+from twisted.internet.threads import deferToThread
+
+# The actuators need the GPIO pins of the Pi, and the cat one the Python 2
+# servo driver, they can be replaced with fake ones anywhere else.
+try:
+    import fish
+except (ImportError, RuntimeError, SyntaxError):
+    fish = None
+try:
+    import cat
+except (ImportError, RuntimeError, SyntaxError):
+    cat = None
+
+
+DEBUG = 0
+try:
+    import pdb
+except ImportError:
+    DEBUG = 0
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorSocketOpen(Error):
+    """ Raised when an error occurs trying to open the socket.
+    """
+    def __init__(self, feeder, errorMsg):
+        self.msg = 'error: failed opening socket connection for %s: %s' % (feeder, errorMsg)
+
+
+class ErrorSocketListen(Error):
+    """ Raised when an error occurs trying to listen on the socket.
+    """
+    def __init__(self, feeder, errorMsg):
+        self.msg = 'error: failed to listen on socket for %s: %s' % (feeder, errorMsg)
+
+
+class ErrorSpecies(Error):
+    """ Raised when the species of a feeder is unknown or its actuator is
+        missing.
+    """
+    def __init__(self, species, reason):
+        self.msg = 'error: species %s: %s' % (species, reason)
+
+
+class Species(object):
+    """ A kind of feeder. makeActuator is called with no arguments to build
+        the actuator of a feeder, which feeds with feed(seconds) and waters
+        with water(seconds). feeders lists the names of the known feeders
+        of the species, and imageFile is where the camera image of the first
+        of them is archived, as it was before the daemon hosted more than one
+        feeder.
+    """
+    def __init__(self, name, makeActuator, imageFile, feeders):
+        self.name = name
+        self.makeActuator = makeActuator
+        self.imageFile = imageFile
+        self.feeders = feeders
+
+
+# Registered species by name.
+SPECIES = {}
+
+
+def registerSpecies(species):
+    """ Adds a Species to the registry, replacing one of the same name.
+    """
+    SPECIES[species.name] = species
+
+
+def getSpecies(name):
+    try:
+        return SPECIES[name]
+    except KeyError:
+        raise ErrorSpecies(name, 'allowable choices are ' + ', '.join(sorted(SPECIES)))
+
+
+def speciesOf(feederName):
+    """ Returns the name of the species of a known feeder, or None.
+    """
+    for species in SPECIES.values():
+        if feederName in species.feeders:
+            return species.name
+    return None
+
+
+def imageFileOf(feederName, species):
+    """ Returns where the camera image of a feeder of the Species species is
+        archived. Only the first known feeder of the species keeps the image
+        file of the species, every other feeder has its own.
+    """
+    if species.feeders and feederName == species.feeders[0]:
+        return species.imageFile
+    return os.path.join('_img', feederName + '.jpg')
+
+
+def isRate(value):
+    """ Returns True if value is a finite number of at least 0, such as the
+        camera and sensor values of a configuration.
+    """
+    return isinstance(value, numbers.Real) and not isinstance(value, bool) and 0 <= value < float('inf')
+
+
+def makeFish():
+    if fish is None:
+        raise ErrorSpecies('fish', 'the fish actuator cannot be loaded')
+    return fish.Fish()
+
+
+def makeCat():
+    if cat is None:
+        raise ErrorSpecies('cat', 'the cat actuator cannot be loaded')
+    return cat.Cat()
+
+registerSpecies(Species('fish', makeFish, '_img/Fish.jpg', ['RASPF1']))
+registerSpecies(Species('cat', makeCat, '_img/cat.jpg', ['RASPC1']))
+
+
+class Periodic(object):
+    """ Runs work on a worker thread, driven by a timer on the reactor, so
+        blocking hardware calls never hold up the reactor. Between runs it
+        waits the number of seconds returned by interval, or by work if that
+        returns a number, and it waits for the next configuration change
+        while interval returns None. Only one run is in flight at a time, and
+        release runs on a worker thread once it stops.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.running = False
+        self.busy = False
+        self.rearm = False
+        self.call = None
+        self.stopping = None
+        self.store.subscribe(self.configChanged)
+
+    def start(self):
+        """ Starts running on the reactor.
+        """
+        self.running = True
+        self.arm()
+
+    def stop(self):
+        """ Stops running. Returns a Deferred that fires once the run in
+            flight is done and release has run.
+        """
+        self.running = False
+        self.arm()
+        self.stopping = Deferred()
+        if not self.busy:
+            self.halt()
+        return self.stopping
+
+    def halt(self):
+        (stopping, self.stopping) = (self.stopping, None)
+        d = deferToThread(self.release)
+        d.addErrback(self.failed)
+        d.chainDeferred(stopping)
+
+    def configChanged(self, version, snapshot):
+        if self.running:
+            reactor.callFromThread(self.arm)
+
+    def arm(self, delay=None):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        if not self.running:
+            return
+        if self.busy:
+            self.rearm = True
+            return
+        if delay is None:
+            # A bad value would otherwise stop the timer for good, so wait
+            # for the next configuration change instead.
+            try:
+                delay = self.interval()
+            except Exception as e:
+                print('%s: %s' % (self.feederName, e))
+        if delay is not None:
+            self.call = reactor.callLater(max(delay, 0), self.fire)
+
+    def fire(self):
+        self.call = None
+        self.busy = True
+        d = deferToThread(self.work)
+        d.addErrback(self.failed)
+        d.addCallback(self.done)
+
+    def failed(self, failure):
+        print('%s: %s' % (self.feederName, failure.getErrorMessage()))
+        return None
+
+    def done(self, delay):
+        self.busy = False
+        if self.stopping is not None:
+            self.halt()
+            return
+        if self.rearm:
+            (self.rearm, delay) = (False, None)
+        self.arm(delay)
+
+    def interval(self):
+        return None
+
+    def work(self):
+        return None
+
+    def release(self):
+        return None
+
+
+class Feeder(Periodic):
+    """ Class for the feeder. Feeds with actuator when the next scheduled
+        feed is due, on a worker thread, and picks up configuration changes.
+        The scheduler can also be driven directly with process. After every
+        wakeup, report is called with the time of the last feed and of the
+        next scheduled one.
+    """
+    def __init__(self, verbosity, feederName, store, clock=time, actuator=None, report=None):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.store = store
+        self.clock = clock
+        self.report = report
+        self.lastFeed = None
+        self.actuator = actuator
+        self.sched = []
+        self.newSched = []
+
+        # One-shot feeds from manual requests, kept apart from the weekly
+        # schedule and keyed by ('once', timestamp) in the timer heap.
+        self.onceSched = []
+        self.newOnceSched = []
+        self.firedOnce = set()
+
+        # Weekly schedule compiled from the auto section of the configuration.
+        self.index = schedule.WeekIndex([])
+        self.indexKey = None
+
+        # Build a scheduler object that holds the feeds until they are due
+        # and notes configuration changes.
+        self.scheduler = schedule.FeedScheduler(self.clock.time)
+
+        # Get woken up on every configuration change, starting with the
+        # current one.
+        Periodic.__init__(self, store)
+        self.scheduler.wakeup()
+
+    def interval(self):
+        if self.scheduler.woken():
+            return 0
+        fireTime = self.scheduler.peek()
+        if fireTime is None:
+            return None
+        return fireTime - self.clock.time()
+
+    def work(self):
+        due = self.scheduler.poll()
+        if due is not None:
+            self.process(due)
+
+    def process(self, due):
+        """ Handles one wakeup of the scheduler, either feeding for the due
+            entries or picking up a configuration change.
+        """
+        # Woken up without anything due means the configuration changed.
+        if not due:
+            if self.buildSched(self.store.get()):
+                self.updateSched()
+
+        for (fireTime, key) in due:
+            # Execute the feeder.
+            self.feedNow()
+
+            if isinstance(key, tuple):
+                self.finishOnce(key)
+            else:
+                # Schedule the same minute of the week again.
+                self.scheduler.add(key, self.index.fireTime(key, fireTime))
+
+        if self.report is not None:
+            self.report(self.lastFeed, self.scheduler.peek())
+
+    def configChanged(self, version, snapshot):
+        """ Tells the feeder to pick up the new configuration.
+        """
+        self.scheduler.wakeup()
+        Periodic.configChanged(self, version, snapshot)
+
+    def buildSched(self, config):
+        """ Compiles the times, days and schedule expressions from the
+            configuration into the weekly index. The index is only rebuilt
+            when they change. Returns True if the schedule changed.
+        """
+        changed = False
+        auto = config['auto']
+        exprs = auto.get('exprs', ())
+        key = (tuple(auto['times']), tuple(auto['days']), tuple(exprs))
+        if key != self.indexKey:
+            # A configuration file edited by hand can still hold a bad time
+            # or day, which leaves only the expressions scheduled.
+            try:
+                index = schedule.WeekIndex.fromTimes(auto['times'], auto['days'])
+            except schedule.Error as e:
+                print('%s: %s' % (self.feederName, e.msg))
+                index = schedule.WeekIndex([])
+            for expr in exprs:
+                try:
+                    index = index | cron.compileExpr(expr)
+                except cron.Error as e:
+                    print('%s: %s' % (self.feederName, e.msg))
+            self.index = index
+            self.indexKey = key
+            self.newSched = self.index.offsets
+            changed = True
+
+        # Leave out one-shots that already fired but are still in a
+        # configuration that was committed before they were removed, and
+        # ones that went overdue while the feeder was not running.
+        once = config.get('once', ())
+        self.firedOnce.intersection_update(once)
+        queue = schedule.OneShotQueue(when for when in once if when not in self.firedOnce)
+        queue.expire(self.clock.time())
+        newOnceSched = [('once', when) for when in queue]
+        if newOnceSched != self.onceSched:
+            self.newOnceSched = newOnceSched
+            changed = True
+        return changed
+
+    def finishOnce(self, key):
+        """ Removes a one-shot feed that fired from the configuration.
+        """
+        self.firedOnce.add(key[1])
+
+        def discard(config):
+            queue = schedule.OneShotQueue(config.get('once', []))
+            queue.discard(key[1])
+            config['once'] = list(queue)
+        self.store.update(discard)
+
+    def feedNow(self):
+        if self.verbosity >= 1:
+            print('%s: Executing feeding...' % self.feederName)
+        self.lastFeed = self.clock.time()
+        if self.report is not None:
+            self.report(self.lastFeed, self.scheduler.peek())
+        self.actuator.feed(0.5)
+        self.actuator.water(4)
+
+    def updateSched(self):
+        """ Reconciles the schedule with the newly built one and applies the
+            difference to the timer heap. Returns the SchedDelta.
+        """
+        delta = schedule.diffSched(self.sched, self.newSched)
+        onceDelta = schedule.diffSched(self.onceSched, self.newOnceSched)
+        if self.verbosity >= 1:
+            for offset in delta.removed:
+                print('%s: Removing feed %s from schedule.' % (self.feederName, schedule.formatOffset(offset)))
+            for offset in delta.added:
+                print('%s: Adding new feed %s to schedule.' % (self.feederName, schedule.formatOffset(offset)))
+            for (once, when) in onceDelta.added:
+                print('%s: Adding one-shot feed %s to schedule.' % (self.feederName, datetime.datetime.fromtimestamp(when)))
+
+        now = self.clock.time()
+        self.scheduler.apply(delta, lambda offset: self.index.fireTime(offset, now))
+        self.scheduler.apply(onceDelta, lambda key: key[1])
+        self.sched = self.newSched
+        self.onceSched = self.newOnceSched
+        return schedule.SchedDelta(delta.added + onceDelta.added, delta.removed + onceDelta.removed)
+
+
+class Camera(Periodic):
+    """ Class for the camera. Frames come from a capture backend that keeps
+        the camera running between frames while the camera is on, and go to
+        the frame ring. A frame is only written to imageFile every archive
+        seconds. With a motion detector, frames that did not change are
+        dropped and the rate slows down while nothing moves. A frame is
+        appended to the time-lapse archive lapse every lapseInterval seconds.
+    """
+    def __init__(self, verbosity, feederName, store, backend, ring, imageFile, archive, detector=None, rate=None,
+                 lapse=None, lapseInterval=60):
+        Periodic.__init__(self, store)
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.backend = backend
+        self.ring = ring
+        self.imageFile = imageFile
+        (root, ext) = os.path.splitext(imageFile)
+        self.tempFile = root + 'Temp' + ext
+        self.archive = archive
+        self.archived = 0
+        self.detector = detector
+        self.rate = rate
+        self.lapse = lapse
+        self.lapseInterval = lapseInterval
+        self.lapsed = 0
+        self.captured = 0
+        self.kept = 0
+        self.started = False
+        self.retry = 5
+
+    def interval(self):
+        # Capture at the current camera value and wait for the configuration
+        # to change while the camera is off, once it is released.
+        fps = self.store.get()['camera']
+        if fps <= 0:
+            return 0 if self.started else None
+        interval = 1.0 / fps
+        if self.rate is not None:
+            interval = self.rate.interval(interval)
+        return interval
+
+    def work(self):
+        if self.store.get()['camera'] <= 0:
+            # Release the camera while it is off.
+            self.release()
+            return None
+        return self.capture()
+
+    def capture(self):
+        """ Captures a frame. Returns the number of seconds to wait before
+            trying again if the backend failed.
+        """
+        if self.verbosity >= 2:
+            sys.stdout.write('%s: Capturing new image...\n' % self.feederName)
+
+        # Capture the image, restarting the backend if it failed.
+        try:
+            if not self.started:
+                self.backend.start()
+                self.started = True
+            image = self.backend.capture()
+        except capture.Error as e:
+            if self.verbosity >= 1:
+                print('%s: %s' % (self.feederName, e.msg))
+            self.release()
+            return self.retry
+        self.captured += 1
+
+        # Drop the frame if nothing moved since the last frame that was kept.
+        if self.detector is not None:
+            (changed, score) = self.detector.check(image)
+            if self.rate is not None:
+                self.rate.update(changed)
+            if not changed:
+                return
+            if self.verbosity >= 2:
+                print('%s: %.1f%% of the image changed.' % (self.feederName, score * 100))
+        self.kept += 1
+        frame = self.ring.push(image)
+
+        # Add the frame to the time-lapse every so often.
+        if self.lapse is not None and frame.when - self.lapsed >= self.lapseInterval:
+            self.lapsed = frame.when
+            try:
+                self.lapse.append(image, frame.when)
+            except (IOError, OSError) as e:
+                if self.verbosity >= 1:
+                    print('%s: Cannot append to the time-lapse: %s' % (self.feederName, e))
+
+        # Archive the frame every so often.
+        if self.archive <= 0 or frame.when - self.archived < self.archive:
+            return
+        self.archived = frame.when
+
+        # Write the temp image.
+        with open(self.tempFile, 'wb') as f:
+            f.write(image)
+
+        # Replace the actual image. Renaming leaves images that are being
+        # sent untouched.
+        os.rename(self.tempFile, self.imageFile)
+
+    def release(self):
+        if self.started:
+            self.backend.stop()
+            self.started = False
+
+
+class Sensor(Periodic):
+    """ Class for the temperature sensor. Every reading is handed to publish,
+        on the worker thread that read it.
+    """
+    def __init__(self, verbosity, feederName, store, publish=None):
+        Periodic.__init__(self, store)
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.publish = publish
+        self.reading = None
+        self.sensorFile = '_doc/sensor.txt'
+
+    def interval(self):
+        # Read at the current sensor value and wait for the configuration to
+        # change while the sensor is off.
+        rps = self.store.get()['sensor']
+        if rps > 0:
+            return 1.0 / rps
+        return None
+
+    def work(self):
+        self.read()
+
+    def read(self):
+        if self.verbosity >= 2:
+            sys.stdout.write('%s: Reading sensor...\n' % self.feederName)
+
+        # Hardware code for reading from the temperature sensor goes
+        # here. Until then the reading comes from the file shown on the info
+        # page, which holds values such as 'Temperature: 70F'.
+        try:
+            with open(self.sensorFile, 'r') as f:
+                text = f.read()
+        except IOError:
+            return
+
+        reading = {'time': time.time()}
+        for (name, value) in re.findall(r'(\w+):\s*(-?\d+(?:\.\d+)?)', text):
+            reading[name.lower()] = float(value)
+        self.reading = reading
+
+        # Push the reading to the subscribers.
+        if self.publish is not None:
+            self.publish(reading)
+
+
+def defaultConfig(feederName):
+    """ Returns the configuration of a feeder that has no configuration file
+        yet, which feeds at noon every day.
+    """
+    return {
+        'feeder': feederName,
+        'man': False,
+        'camera': 1,
+        'sensor': 1,
+        'auto': {
+            'times': ['12:00'],
+            'days': ['ALL'],
+            'exprs': []
+        }
+    }
+
+
+class Config(object):
+    def __init__(self, verbosity, feederName, store, man, times, days, exprs, camera, sensor, clock=time):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.store = store
+        self.clock = clock
+        self.config = None
+        self.newConfig = {
+            'feeder': feederName,      # Feeder to connect to
+            'man': man,            # Boolean true if manual feed
+            'camera': camera,      # Frames per second of the camera
+            'sensor': sensor,      # Sensor readings per second
+            'auto': {              # Dictionary for automatic configuration
+                'times': times,    # List of times during the day to feed
+                'days': days,      # List of days to feed
+                'exprs': exprs     # List of schedule expressions
+            }
+        }
+
+    def readConfig(self):
+        """ Takes a mutable copy of the current configuration.
+        """
+        self.config = configstore.thaw(self.store.get())
+
+    def writeConfig(self):
+        """ Commits the configuration to the store, which writes the
+            configuration file and notifies the other threads.
+        """
+        self.store.commit(self.config)
+
+    def processMan(self):
+        """ Processes a manual request and updates the configuration file.
+            Returns False, leaving the configuration file untouched, if the
+            manual feed could not be queued.
+        """
+        if self.newConfig['man']:
+            if self.verbosity >= 1:
+                print('%s: Processing manual request to start feeding.' % self.feederName)
+            self.newConfig['man'] = False
+            if not self.queueFeed(120):
+                return False
+        self.updateConfig()
+        return True
+
+    def requestFeed(self):
+        """ Feeds right away, keeping the rest of the configuration. Returns
+            False if the feed could not be queued.
+        """
+        if self.verbosity >= 1:
+            print('%s: Processing request to feed now.' % self.feederName)
+        self.readConfig()
+        self.newConfig = configstore.thaw(self.store.get())
+        if not self.queueFeed(0):
+            return False
+        self.updateConfig()
+        return True
+
+    def queueFeed(self, delay):
+        """ Queues a one-shot feed delay seconds from now instead of adding a
+            weekly feed to the automatic configuration. Returns False if too
+            many manual feeds are pending.
+        """
+        now = self.clock.time()
+        queue = schedule.OneShotQueue(self.config.get('once', []))
+        queue.expire(now)
+        if not queue.push(int(now) + delay):
+            if self.verbosity >= 1:
+                print('%s: Too many pending manual feeds, ignoring request.' % self.feederName)
+            return False
+        self.newConfig['once'] = list(queue)
+        return True
+
+    def updateConfig(self):
+        """ Updates the configuration file. Raises configstore.ErrorConfig or,
+            for a time or day that is not valid, schedule.Error, leaving the
+            configuration file untouched.
+        """
+        # Make sure to keep the default values in place.
+        if self.newConfig['sensor'] == 0:
+            self.newConfig['sensor'] = self.config['sensor']
+        if self.newConfig['camera'] == 0:
+            self.newConfig['camera'] = self.config['camera']
+        if not self.newConfig['auto']['times']:
+            self.newConfig['auto']['times'] = self.config['auto']['times']
+        if not self.newConfig['auto']['days']:
+            self.newConfig['auto']['days'] = self.config['auto']['days']
+        if not self.newConfig['auto'].get('exprs'):
+            self.newConfig['auto']['exprs'] = self.config['auto'].get('exprs', [])
+
+        # Reject values that are not valid so they never reach the feeder,
+        # and drop schedule expressions that do not compile.
+        if self.newConfig.get('feeder') != self.feederName:
+            raise configstore.ErrorConfig('feeder is %s, not %s' % (self.feederName, self.newConfig.get('feeder')))
+        for key in ['camera', 'sensor']:
+            if not isRate(self.newConfig[key]):
+                raise configstore.ErrorConfig('%s must be a number of at least 0, not %s' % (key, json.dumps(self.newConfig[key])))
+        schedule.WeekIndex.fromTimes(self.newConfig['auto']['times'], self.newConfig['auto']['days'])
+        exprs = []
+        for expr in self.newConfig['auto']['exprs']:
+            try:
+                cron.compileExpr(expr)
+                exprs.append(expr)
+            except cron.Error as e:
+                print('%s: %s' % (self.feederName, e.msg))
+        self.newConfig['auto']['exprs'] = exprs
+        if 'once' not in self.newConfig:
+            self.newConfig['once'] = self.config.get('once', [])
+
+        # Show the changes.
+        if self.verbosity >= 1:
+            print('%s: Updating configuration file...' % self.feederName)
+            try:
+                for key in self.config.keys():
+                    if type(self.config[key]) is dict:
+                        for subkey in self.config[key].keys():
+                            if self.config[key][subkey] != self.newConfig[key][subkey]:
+                                print('%s: Updating %s from %s to %s.' % (self.feederName, subkey, self.config[key][subkey], self.newConfig[key][subkey]))
+                    elif self.config[key] != self.newConfig[key]:
+                        print('%s: Updating %s from %s to %s.' % (self.feederName, key, self.config[key], self.newConfig[key]))
+            except ValueError:
+                if self.verbosity >= 1:
+                    print('%s: Configuration file does not contain a valid JSON object.' % self.feederName)
+                if self.verbosity == 2:
+                    print('%s: Overwriting configuration file to: %s.' % (self.feederName, self.config))
+
+        # Change the configuration file.
+        self.config = self.newConfig
+        self.writeConfig()
+
+
+class FeederHost(object):
+    """ One feeder of the daemon, of the species named species, with its
+        configuration, schedule, camera, sensor and the server that allows a
+        client to change its configuration.
+    """
+    def __init__(self, verbosity, ip, port, feederName, species, man, times, days, exprs, camera, sensor, watch, backend='raspistill', archive=60,
+                 idle=10, lapse=0, lapseSize=256, lapseDays=7):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.species = getSpecies(species)
+        self.configFile = feederName + '.config'
+        self.store = configstore.ConfigStore(verbosity, feederName, self.configFile)
+        self.config = Config(verbosity, feederName, self.store, man, times, days, exprs, camera, sensor)
+        self.watch = watch
+        self.backend = capture.openBackend(backend)
+        self.ring = capture.FrameRing(16, capture.SIZES)
+        self.archive = archive
+        self.idle = idle
+        self.lapseInterval = lapse
+        self.lapse = None
+        if lapse > 0:
+            self.lapse = timelapse.Archive(verbosity, feederName, os.path.join('_lapse', feederName), lapseSize * 1024 * 1024, lapseDays * 86400)
+        self.server = None
+        self.factory = None
+        self.host = ip
+        self.port = port
+        self.backlog = 50
+        self.timeout = 300
+        self.imageFile = imageFileOf(feederName, self.species)
+        self.imageCrc = (None, None)
+        self.sensor = None
+        self.status = infoServer.Status(feederName)
+        self.lastFeed = None
+        self.store.subscribe(self.configChanged)
+        self.ring.addListener(self.status.frameCaptured)
+
+    def openSocket(self):
+        """ Starts listening for control connections on the reactor.
+        """
+        self.factory = configserver.ConfigFactory(self.verbosity, self.feederName, self.config, self.openImage, self.readSensor, self.timeout)
+        try:
+            self.server = reactor.listenTCP(self.port, self.factory, backlog=self.backlog, interface=self.host)
+        except CannotListenError as e:
+            raise ErrorSocketOpen(self.feederName, str(e.socketError))
+        if self.verbosity >= 1:
+            print('Starting config server for %s at %s, port %s.' % (self.feederName, self.host, self.port))
+
+    def start(self):
+        """ Starts the feeder on the reactor.
+        """
+        # Make sure that a socket is open before running.
+        if self.server is None:
+            raise Error('')
+
+        # Load the configuration file once and apply the command line
+        # arguments before the hardware reads it.
+        self.store.load(defaultConfig(self.feederName))
+        self.config.readConfig()
+        if not self.config.processMan():
+            print('%s: Too many pending manual feeds, not feeding now.' % self.feederName)
+        if self.watch:
+            self.store.watch()
+
+        (detector, rate) = (None, None)
+        if self.idle > 0:
+            if motion.available():
+                detector = motion.MotionDetector()
+                rate = motion.AdaptiveRate(self.idle)
+            elif self.verbosity >= 1:
+                print('%s: Motion detection needs NumPy and PIL, keeping every frame.' % self.feederName)
+        if self.lapse is not None:
+            self.lapse.open()
+
+        # Drive the hardware from timers on the reactor. Only the blocking
+        # calls go to the worker threads of the reactor.
+        self.camera = Camera(self.verbosity, self.feederName, self.store, self.backend, self.ring, self.imageFile, self.archive, detector, rate,
+                             self.lapse, self.lapseInterval)
+        self.sensor = Sensor(self.verbosity, self.feederName, self.store, self.publishReading)
+        self.feeder = Feeder(self.verbosity, self.feederName, self.store, actuator=self.species.makeActuator(), report=self.reportFeeds)
+        self.camera.start()
+        self.sensor.start()
+        self.feeder.start()
+
+        # Let the runs in flight finish before the worker threads are
+        # stopped, then release the camera.
+        for periodic in [self.camera, self.sensor, self.feeder]:
+            reactor.addSystemEventTrigger('before', 'shutdown', periodic.stop)
+
+    def openImage(self, crc=None):
+        """ Opens the camera image and returns the file, its size and its
+            CRC-32. That is the buffered frame with the CRC-32 crc while it is
+            in the frame ring, so that an interrupted transfer can resume, or
+            else the latest frame. Falls back to the archived image while no
+            frame is buffered. Called on a worker thread.
+        """
+        frame = None
+        if crc is not None:
+            frame = self.ring.find(crc)
+        if frame is None:
+            frame = self.ring.latest()
+        if frame is not None:
+            return (io.BytesIO(frame.data), len(frame.data), frame.crc())
+
+        # The checksum is only computed once per archived image.
+        f = open(self.imageFile, 'rb')
+
+        stat = os.fstat(f.fileno())
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        (cachedKey, crc) = self.imageCrc
+        if key != cachedKey:
+            crc = 0
+            for chunk in iter(lambda: f.read(65536), b''):
+                crc = zlib.crc32(chunk, crc)
+            crc &= 0xffffffff
+            self.imageCrc = (key, crc)
+        return (f, stat.st_size, crc)
+
+    def publishReading(self, reading):
+        """ Pushes a sensor reading to the subscribers. Called on a worker
+            thread.
+        """
+        reactor.callFromThread(self.factory.publish, reading)
+        self.status.updateFromThread('sensor', sensor=reading)
+
+    def configChanged(self, version, snapshot):
+        self.status.updateFromThread('config', config=snapshot)
+
+    def reportFeeds(self, lastFeed, nextFeed):
+        # Called after every wakeup of the feeder, which is a feed if the
+        # time of the last feed moved.
+        event = 'schedule'
+        if lastFeed != self.lastFeed:
+            (event, self.lastFeed) = ('feed', lastFeed)
+        self.status.updateFromThread(event, lastFeed=lastFeed, nextFeed=nextFeed)
+
+    def readSensor(self):
+        """ Returns the latest sensor reading.
+        """
+        if self.sensor is None:
+            return None
+        return self.sensor.reading
+
+
+class PiFeed(object):
+    """ Runs the feeder hosts on one reactor, with one info server for all
+        of them on webPort.
+    """
+    def __init__(self, verbosity, hosts, webPort=8000, root='/home/pi/PiFeed/src/'):
+        self.verbosity = verbosity
+        self.hosts = hosts
+        self.webPort = webPort
+        self.root = root
+        self.requestThreads = 10
+        self.hostThreads = 4
+
+    def openSockets(self):
+        for host in self.hosts:
+            host.openSocket()
+
+    def run(self):
+        """ Runs the feeders.
+        """
+        # Every feeder has at most one run of its camera, sensor and feeder
+        # and one commit on the worker threads at a time, so give each of
+        # them a thread on top of the threads for the requests. Otherwise the
+        # feeds of one feeder could wait for the captures of the others.
+        reactor.suggestThreadPoolSize(self.requestThreads + self.hostThreads * len(self.hosts))
+        info = infoServer.InfoServer(self.verbosity, self.root)
+        for host in self.hosts:
+            host.start()
+            info.addFeeder(host.feederName, host.ring, host.imageFile, host.lapse, host.status)
+        info.listen(self.webPort)
+
+        # Serve the control connections and the info server until the user
+        # quits with CTR-C.
+        reactor.run()
+
+
+def parseFeeder(text):
+    """ Parses a feeder given as NAME, NAME:SPECIES or NAME:SPECIES:PORT
+        into a (name, species, port) tuple, with None for the parts left out.
+    """
+    parts = text.split(':')
+    if len(parts) > 3 or not parts[0]:
+        raise argparse.ArgumentTypeError('feeder is NAME[:SPECIES[:PORT]]: %s' % text)
+    (name, species, port) = (parts + [None, None])[:3]
+    if port is not None:
+        try:
+            port = int(port)
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad port of feeder %s' % name)
+    return (name, species or None, port)
+
+
+class PiFeedArgs(object):
+    """ Argument parser for PiFeed. Started as prog for a single species,
+        only one feeder of that species can be hosted.
+    """
+    def __init__(self, prog='pifeed', species=None):
+        # Basic info.
+
+        self.version = 1.0
+        self.name = prog
+        self.species = species
+        self.date = '11/11/14'
+        self.author = 'Igor Janjic, Danny Duangphachanh, and Daniel Friedman'
+        self.organ = '[ECE 4564] Network Applications Design at Virginia Tech'
+        self.epil = 'Thank you for using %s version %s. Created by %s on %s for %s.' % (self.name, self.version, self.author, self.date, self.organ)
+
+        self.daysOfWeek = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN', 'ALL', 'NONE']
+
+        # List of possible feeders can be extended for future additions.
+        if species is None:
+            self.possibleFeeders = sorted(name for s in SPECIES.values() for name in s.feeders)
+            self.desc = 'A server application for any number of feeders.'
+            self.feederHelp = ('Feeders to host, as NAME[:SPECIES[:PORT]]. The species of ' + ', '.join(self.possibleFeeders) +
+                               ' is known. Feeders without a port get the ports after the last one.')
+        else:
+            self.possibleFeeders = getSpecies(species).feeders
+            self.desc = 'A server application for feeder ' + ', '.join(self.possibleFeeders) + '.'
+            self.feederHelp = 'Feeder to connect to. Allowable choices are ' + ', '.join(self.possibleFeeders) + '.'
+
+        # Arguments help.
+        self.ipHelp = 'IP address of the server.'
+        self.portHelp = 'Port to open for connections.'
+        self.webHelp = 'Port of the info server. Default is 8000.'
+        self.helpHelp = 'Show this help message and exit.'
+        self.verbHelp = 'Increase output verbosity.'
+        self.manHelp = 'Manually start feeding.'
+        self.timeHelp = 'A list of times to feed. Allowable choices are from 0:00 to 23:99. Default is 12:00.'
+        self.daysHelp = 'A list of days to feed. Allowable choices are ' + ', '.join(self.daysOfWeek) + '. Default is ALL days of the week.'
+        self.exprHelp = 'A list of schedule expressions, such as "every 90 minutes between 07:00 and 21:00 on weekdays" or "30 7 * * 1-5".'
+        self.cameraHelp = 'Frames per second of the camera.'
+        self.sensorHelp = 'Number of times to query the temperature sensor per second, such as 0.1 for every ten seconds.'
+        self.watchHelp = 'Watch the configuration file for changes made by other programs.'
+        self.archiveHelp = 'Seconds between camera frames written to disk. Zero disables writing them. Default is 60.'
+        self.idleHelp = 'Longest number of seconds between camera frames while nothing moves. Zero keeps every frame at the camera rate. Default is 10.'
+        self.lapseHelp = 'Seconds between camera frames added to the time-lapse archive in _lapse. Zero disables the archive. Default is 0.'
+        self.lapseSizeHelp = 'Megabytes the time-lapse archive may take before its oldest frames are removed. Default is 256.'
+        self.lapseDaysHelp = 'Days the time-lapse archive keeps frames. Default is 7.'
+        self.backendHelp = 'Camera backend. Allowable choices are ' + ', '.join(capture.BACKENDS) + '. Default is raspistill.'
+
+        # Argparser.
+        self.argParser = argparse.ArgumentParser(prog=self.name, description=self.desc, epilog=self.epil, add_help=False)
+        requiredArgs = self.argParser.add_argument_group('Required arguments', '')
+        optionalArgs = self.argParser.add_argument_group('Optional arguments', '')
+
+        requiredArgs.add_argument('-i', '--ip', type=str, dest='ip', required=True, help=self.ipHelp, metavar='\b')
+        requiredArgs.add_argument('-p', '--port', type=int, dest='port', required=True, help=self.portHelp, metavar='\b')
+        if species is None:
+            requiredArgs.add_argument('-f', '--feeder', type=parseFeeder, dest='feeders', required=True, nargs='+', help=self.feederHelp, metavar='[\b')
+        else:
+            requiredArgs.add_argument('-f', '--feeder', type=str, dest='feeder', required=True, help=self.feederHelp, choices=self.possibleFeeders,
+                                      metavar='\b')
+        optionalArgs.add_argument('-h', '--help', action='help', help=self.helpHelp)
+        optionalArgs.add_argument('-v', '--verbosity', action='count', default=0, help=self.verbHelp)
+        optionalArgs.add_argument('-m', '--manual', dest='man', action='store_true', default=False, help=self.manHelp)
+        optionalArgs.add_argument('-c', '--camera', type=int, dest='camera', default=0, help=self.cameraHelp, metavar='\b')
+        optionalArgs.add_argument('-s', '--sensor', type=float, dest='sensor', default=0, help=self.sensorHelp, metavar='\b')
+        optionalArgs.add_argument('-t', dest='times', default=[], nargs='+', help=self.timeHelp, metavar='[\b')
+        optionalArgs.add_argument('-d', type=str, dest='days', default=[], nargs='+', help=self.daysHelp, choices=self.daysOfWeek, metavar='[\b')
+        optionalArgs.add_argument('-e', type=str, dest='exprs', default=[], nargs='+', help=self.exprHelp, metavar='[\b')
+        optionalArgs.add_argument('-b', '--backend', type=str, dest='backend', default='raspistill', choices=capture.BACKENDS, help=self.backendHelp, metavar='\b')
+        optionalArgs.add_argument('-a', '--archive', type=int, dest='archive', default=60, help=self.archiveHelp, metavar='\b')
+        optionalArgs.add_argument('-x', '--idle', type=float, dest='idle', default=10, help=self.idleHelp, metavar='\b')
+        optionalArgs.add_argument('-l', '--lapse', type=float, dest='lapse', default=0, help=self.lapseHelp, metavar='\b')
+        optionalArgs.add_argument('--lapse-size', type=int, dest='lapseSize', default=256, help=self.lapseSizeHelp, metavar='\b')
+        optionalArgs.add_argument('--lapse-days', type=float, dest='lapseDays', default=7, help=self.lapseDaysHelp, metavar='\b')
+        optionalArgs.add_argument('-w', '--watch', dest='watch', action='store_true', default=False, help=self.watchHelp)
+        optionalArgs.add_argument('-W', '--web', type=int, dest='web', default=8000, help=self.webHelp, metavar='\b')
+
+    def parse(self):
+        self.args = self.argParser.parse_args()
+        for curTime in self.args.times:
+            try:
+                datetime.datetime.strptime(curTime, '%H:%M')
+            except ValueError:
+                raise Error('invalid time format')
+        for expr in self.args.exprs:
+            cron.compileExpr(expr)
+
+        # Work out the species and port of every feeder.
+        if self.species is not None:
+            self.args.feeders = [(self.args.feeder, self.species, self.args.port)]
+            return
+        feeders = []
+        imageFiles = {}
+        port = self.args.port
+        for (name, species, feederPort) in self.args.feeders:
+            if name in [feeder[0] for feeder in feeders]:
+                raise Error('feeder %s is given twice' % name)
+            if species is None:
+                species = speciesOf(name)
+                if species is None:
+                    raise Error('the species of feeder %s is unknown' % name)
+            imageFile = imageFileOf(name, getSpecies(species))
+            if imageFile in imageFiles:
+                raise Error('feeders %s and %s would share the image %s' % (imageFiles[imageFile], name, imageFile))
+            imageFiles[imageFile] = name
+            if feederPort is None:
+                feederPort = port
+            port = feederPort + 1
+            feeders.append((name, species, feederPort))
+        self.args.feeders = feeders
+
+
+def main(prog='pifeed', species=None):
+    if DEBUG:
+        pdb.set_trace()
+    try:
+        args = PiFeedArgs(prog, species)
+        args.parse()
+        args = args.args
+    except argparse.ArgumentError as e:
+        print(e.strerror)
+    except Error as e:
+        print(e.msg)
+        sys.exit(1)
+    except cron.Error as e:
+        print(e.msg)
+        sys.exit(1)
+
+    try:
+        hosts = []
+        for (name, species, port) in args.feeders:
+            hosts.append(FeederHost(args.verbosity, args.ip, port, name, species, args.man, args.times, args.days, args.exprs, args.camera, args.sensor,
+                                    args.watch, args.backend, args.archive, args.idle, args.lapse, args.lapseSize, args.lapseDays))
+        pf = PiFeed(args.verbosity, hosts, args.web)
+        pf.openSockets()
+        pf.run()
+    except ErrorSocketOpen as e:
+        print(e.msg)
+    except ErrorSocketListen as e:
+        print(e.msg)
+        sys.exit(1)
+    except Error as e:
+        print(e.msg)
+        sys.exit(1)
+    except configstore.Error as e:
+        print(e.msg)
+        sys.exit(1)
+    except schedule.Error as e:
+        print(e.msg)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print('\nClosing.')
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,24 @@ manual or automatic operation. Also receives information from the pet feeders.
 __author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
 __version__ = '0.1'
 
+import fleet
+import wire
+
 import argparse
+import binascii
+import collections
+import itertools
 import json
+import os
 import socket
 import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 DEBUG = 0
 try:
@@ -44,6 +58,13 @@ class ErrorInvalidResponse(Error):
             % (feeder, response)
 
 
+class ErrorChecksum(Error):
+    """ Raised when a received image does not match its checksum.
+    """
+    def __init__(self, path):
+        self.msg = 'error: checksum mismatch in image %s' % path
+
+
 class PiFeedControlArgs(object):
     """ Argument parser for PiFeed.
     """
@@ -60,112 +81,692 @@ class PiFeedControlArgs(object):
 
         self.daysOfWeek = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN', 'ALL', 'NONE']
 
-        # List of possible fish feeders can be extended for future additions.
-        self.possibleFeeders = ['RASPF1', 'RASPC1']
-
         # Arguments help.
-        self.ipHelp = 'IP address of the server.'
-        self.portHelp = 'Port to connect to.'
+        self.ipHelp = 'IP address of the server. Overrides the inventory when a single feeder is given.'
+        self.portHelp = 'Port to connect to. Overrides the inventory when a single feeder is given.'
 
-        self.feederHelp = 'Feeder to connect to. Allowable choices are ' + ', '.join(self.possibleFeeders) + '.'
+        self.feederHelp = 'A list of feeders to connect to, named as in the inventory, or ALL for every feeder in the inventory.'
+        self.inventoryHelp = 'Inventory file of the feeders. Default is feeders.json.'
+        self.workersHelp = 'Number of feeders to contact at once. Default is 32.'
         self.helpHelp = 'Show this help message and exit.'
         self.verbHelp = 'Increase output verbosity.'
         self.manHelp = 'Manually start feeding.'
         self.timeHelp = 'A list of times to feed. Allowable choices are from 0:00 to 23:99. Default is 12:00.'
         self.daysHelp = 'A list of days to feed. Allowable choices are ' + ', '.join(self.daysOfWeek) + '. Default is ALL days of the week.'
+        self.exprHelp = 'A list of schedule expressions, such as "every 90 minutes between 07:00 and 21:00 on weekdays" or "30 7 * * 1-5".'
         self.cameraHelp = 'Frames per second of the camera.'
-        self.sensorHelp = 'Number of times to query the temperature sensor per second.'
+        self.sensorHelp = 'Number of times to query the temperature sensor per second, such as 0.1 for every ten seconds.'
+        self.imageHelp = 'Fetch the latest camera image.'
+        self.readingHelp = 'Fetch the latest sensor reading.'
+        self.batchHelp = 'Run the commands of a file, or - for standard input, with one JSON object per line such as {"feeder": "ALL", "op": "config", "times": ["08:00"]}, and print one JSON result per command.'
+        self.subscribeHelp = 'Stream the sensor readings of a single feeder in batches of the given number of seconds until CTRL-C.'
 
         # Argparser.
         self.argParser = argparse.ArgumentParser(prog=self.name, description=self.desc, epilog=self.epil, add_help=False)
         requiredArgs = self.argParser.add_argument_group('Required arguments', '')
         optionalArgs = self.argParser.add_argument_group('Optional arguments', '')
 
-        requiredArgs.add_argument('-i', '--ip', type=str, dest='ip', required=True, help=self.ipHelp, metavar='\b')
-        requiredArgs.add_argument('-p', '--port', type=int, dest='port', required=True, help=self.portHelp, metavar='\b')
-
-        requiredArgs.add_argument('-f', '--feeder', type=str, dest='feeder', required=True, help=self.feederHelp, choices=self.possibleFeeders, metavar='\b')
+        targetArgs = requiredArgs.add_mutually_exclusive_group(required=True)
+        targetArgs.add_argument('-f', '--feeder', type=str, dest='feeders', nargs='+', help=self.feederHelp, metavar='[\b')
+        targetArgs.add_argument('-b', '--batch', type=str, dest='batch', default=None, help=self.batchHelp, metavar='\b')
         optionalArgs.add_argument('-h', '--help', action='help', help=self.helpHelp)
+        optionalArgs.add_argument('-i', '--ip', type=str, dest='ip', default=None, help=self.ipHelp, metavar='\b')
+        optionalArgs.add_argument('-p', '--port', type=int, dest='port', default=None, help=self.portHelp, metavar='\b')
+        optionalArgs.add_argument('-n', '--inventory', type=str, dest='inventory', default='feeders.json', help=self.inventoryHelp, metavar='\b')
+        optionalArgs.add_argument('-w', '--workers', type=int, dest='workers', default=32, help=self.workersHelp, metavar='\b')
         optionalArgs.add_argument('-v', '--verbosity', action='count', default=0, help=self.verbHelp)
         optionalArgs.add_argument('-m', '--manual', dest='man', action='store_true', default=False, help=self.manHelp)
         optionalArgs.add_argument('-c', '--camera', type=int, dest='camera', default=1, help=self.cameraHelp, metavar='\b')
-        optionalArgs.add_argument('-s', '--sensor', type=int, dest='sensor', default=0, help=self.sensorHelp, metavar='\b')
+        optionalArgs.add_argument('-s', '--sensor', type=float, dest='sensor', default=0, help=self.sensorHelp, metavar='\b')
+        optionalArgs.add_argument('-g', '--get-image', dest='image', action='store_true', default=False, help=self.imageHelp)
+        optionalArgs.add_argument('-r', '--read-sensor', dest='reading', action='store_true', default=False, help=self.readingHelp)
+        optionalArgs.add_argument('-u', '--subscribe', type=float, dest='subscribe', default=None, help=self.subscribeHelp, metavar='\b')
         optionalArgs.add_argument('-t', dest='times', default=[], nargs='+', help=self.timeHelp, metavar='[\b')
         optionalArgs.add_argument('-d', type=str, dest='days', default=[], nargs='+', help=self.daysHelp, choices=self.daysOfWeek, metavar='[\b')
+        optionalArgs.add_argument('-e', type=str, dest='exprs', default=[], nargs='+', help=self.exprHelp, metavar='[\b')
 
     def parse(self):
         self.args = self.argParser.parse_args()
+        if self.args.workers < 1:
+            self.argParser.error('the number of workers must be at least 1')
+
+
+class ImageSink(object):
+    """ Writes a received image straight to disk.
+
+        The image is received in place into a preallocated buffer and goes to
+        a partial file named after the checksum of the image until it is
+        complete, so a transfer that was cut short is resumed from where it
+        stopped by the next request for the same image.
+    """
+    def __init__(self, path, chunkSize=65536):
+        self.path = path
+        self.buf = bytearray(chunkSize)
+        self.received = 0
+
+    def partPath(self, crc):
+        return '%s.%08x.part' % (self.path, crc)
+
+    def parts(self):
+        """ Returns a list of (crc, path) of the partial files of the image.
+        """
+        (dirName, baseName) = os.path.split(self.path)
+        parts = []
+        for name in os.listdir(dirName or '.'):
+            if name.startswith(baseName + '.') and name.endswith('.part'):
+                try:
+                    crc = int(name[len(baseName) + 1:-len('.part')], 16)
+                except ValueError:
+                    continue
+                parts.append((crc, os.path.join(dirName, name)))
+        return parts
+
+    def resume(self):
+        """ Returns the byte offset and the checksum of the newest partial
+            image to resume from, or (0, None) if there is nothing to resume.
+        """
+        parts = self.parts()
+        if not parts:
+            return (0, None)
+        (crc, path) = max(parts, key=lambda part: os.path.getmtime(part[1]))
+        return (os.path.getsize(path), crc)
+
+    def receive(self, recvExactly, length):
+        """ Receives an IMAGE payload of length bytes with recvExactly and
+            returns the path of the image.
+        """
+        header = bytearray(wire.IMAGE_HEADER.size)
+        recvExactly(memoryview(header))
+        (size, offset, crc) = wire.IMAGE_HEADER.unpack_from(bytes(header))
+        if length != wire.IMAGE_HEADER.size + size - offset:
+            raise wire.ErrorFrame('image of %d bytes does not fit in %d' % (size - offset, length))
+
+        # Drop the partial files of other images.
+        partPath = self.partPath(crc)
+        for (partCrc, path) in self.parts():
+            if path != partPath:
+                os.remove(path)
+
+        running = 0
+        if offset:
+            f = open(partPath, 'r+b')
+            for chunk in iter(lambda: f.read(min(len(self.buf), offset - f.tell())), b''):
+                running = binascii.crc32(chunk, running)
+            f.truncate(offset)
+        else:
+            f = open(partPath, 'wb')
+
+        view = memoryview(self.buf)
+        remaining = size - offset
+        try:
+            while remaining:
+                chunk = view[:min(remaining, len(view))]
+                recvExactly(chunk)
+                f.write(chunk)
+                running = binascii.crc32(chunk, running)
+                remaining -= len(chunk)
+                self.received += len(chunk)
+        finally:
+            f.close()
+
+        if running & 0xffffffff != crc:
+            os.remove(partPath)
+            raise ErrorChecksum(self.path)
+        os.rename(partPath, self.path)
+        return self.path
+
+
+class Request(object):
+    """ A request in flight on a PiFeedSession.
+    """
+    def __init__(self, requestId, msgType, sink=None):
+        self.requestId = requestId
+        self.msgType = msgType
+        self.sink = sink
+        self.event = threading.Event()
+        self.response = None
+        self.error = None
+        self.sent = time.time()
+        self.elapsed = None
+
+    def done(self, msgType, payload):
+        self.response = (msgType, payload)
+        self.elapsed = time.time() - self.sent
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.elapsed = time.time() - self.sent
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the response arrives and returns its (msgType,
+            payload). Raises the error the request failed with.
+        """
+        if not self.event.wait(timeout):
+            raise ErrorSocket(None, 'request %d timed out' % self.requestId)
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+class Subscription(object):
+    """ Sensor readings pushed by a feeder on a PiFeedSession.
+
+        Taking a batch with get returns one credit to the feeder, which never
+        sends more batches than the client has credit for, so at most window
+        batches wait here for a slow reader.
+    """
+    def __init__(self, session, subscriptionId):
+        self.session = session
+        self.subscriptionId = subscriptionId
+        self.batches = queue.Queue()
+
+    def get(self, timeout=None):
+        """ Blocks until a batch arrives and returns its readings and the
+            number of readings the feeder dropped before it.
+        """
+        try:
+            batch = self.batches.get(True, timeout)
+        except queue.Empty:
+            return ([], 0)
+        if batch is None:
+            raise ErrorSocket(self.session.feeder, 'connection closed')
+        self.session.sendCredit(self.subscriptionId)
+        return (batch.get('readings', []), batch.get('dropped', 0))
+
+    def close(self):
+        self.session.unsubscribe(self)
+
+
+class PiFeedSession(object):
+    """ Long-lived control session with a feeder.
+
+        Any number of requests can be in flight on the connection at once.
+        Every request carries an ID which the feeder echoes in its response,
+        and a reader thread hands each response to the request it answers, so
+        responses are matched even when they come back out of order. The send
+        methods return a Request right away, and the blocking methods send one
+        request and wait for its response.
+    """
+    def __init__(self, verbosity, feeder, host, port, timeout=10, recvSize=65536):
+        self.verbosity = verbosity
+        self.feeder = feeder
+        self.timeout = timeout
+        self.recvSize = recvSize
+        self.requestIds = itertools.count(1)
+        self.pending = {}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+        try:
+            self.sock = socket.create_connection((host, port), timeout)
+            self.sock.settimeout(None)
+        except socket.error as e:
+            raise ErrorSocket(feeder, e.strerror or str(e))
+        if self.verbosity >= 1:
+            print('Connected to server %s at %s.' % (host, port))
+
+        self.reader = threading.Thread(target=self.read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def send(self, msgType, payload=b'', sink=None):
+        """ Sends a request and returns its Request without waiting for the
+            response.
+        """
+        with self.lock:
+            if self.closed:
+                raise ErrorSocket(self.feeder, 'session is closed')
+            request = Request(next(self.requestIds), msgType, sink)
+            self.pending[request.requestId] = request
+            if msgType == wire.SUBSCRIBE:
+                self.subscriptions[request.requestId] = Subscription(self, request.requestId)
+            try:
+                self.sock.sendall(wire.encode(msgType, request.requestId, payload))
+            except socket.error as e:
+                del self.pending[request.requestId]
+                self.subscriptions.pop(request.requestId, None)
+                raise ErrorSocket(self.feeder, e.strerror or str(e))
+        return request
+
+    def sendCredit(self, subscriptionId, credit=1):
+        """ Lets the feeder send credit more batches to a subscription. Not
+            answered by the feeder.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(wire.encodeJson(wire.CREDIT, subscriptionId, {'credit': credit}))
+            except socket.error as e:
+                raise ErrorSocket(self.feeder, e.strerror or str(e))
+
+    def sendConfig(self, config):
+        return self.send(wire.CONFIG, json.dumps(config).encode('utf-8'))
+
+    def sendFeed(self):
+        return self.send(wire.FEED)
+
+    def sendImage(self, path):
+        sink = ImageSink(path, self.recvSize)
+        (offset, crc) = sink.resume()
+        return self.send(wire.IMAGE, json.dumps({'offset': offset, 'crc': crc}).encode('utf-8'), sink)
+
+    def sendSensor(self):
+        return self.send(wire.SENSOR)
+
+    def result(self, request, expected):
+        """ Waits for the response to request and returns its payload. Images
+            are waited for as long as they keep arriving.
+        """
+        if request.sink is not None:
+            received = request.sink.received
+            while not request.event.wait(self.timeout) and request.sink.received != received:
+                received = request.sink.received
+        (msgType, payload) = request.wait(self.timeout)
+        if msgType == wire.ERROR:
+            raise ErrorInvalidResponse(self.feeder, payload.decode('utf-8'))
+        if msgType != expected:
+            raise ErrorInvalidResponse(self.feeder, 'unexpected message type %d' % msgType)
+        return payload
+
+    def config(self, config):
+        """ Sends a configuration and waits for the feeder to accept it.
+        """
+        self.result(self.sendConfig(config), wire.ACK)
+
+    def feed(self):
+        """ Asks the feeder to feed right away.
+        """
+        self.result(self.sendFeed(), wire.ACK)
+
+    def image(self, path):
+        """ Saves the latest JPEG image of the feeder's camera to path and
+            returns path.
+        """
+        return self.result(self.sendImage(path), wire.IMAGE)
+
+    def sensor(self):
+        """ Returns the latest sensor reading of the feeder.
+        """
+        return wire.decodeJson(self.result(self.sendSensor(), wire.SENSOR))
+
+    def recvExactly(self, view):
+        """ Receives into all of the memoryview view. Returns False if the
+            connection was closed before anything was received.
+        """
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                if received:
+                    raise ErrorSocket(self.feeder, 'connection closed')
+                return False
+            received += n
+        return True
+
+    def subscribe(self, interval=1, window=4, maxBuffer=64):
+        """ Subscribes to the sensor readings of the feeder and returns a
+            Subscription. The feeder sends the readings in batches every
+            interval seconds, sends at most window batches ahead of the ones
+            taken, and keeps at most maxBuffer readings for a subscriber that
+            is out of credit.
+        """
+        options = {'interval': interval, 'window': window, 'buffer': maxBuffer}
+        request = self.send(wire.SUBSCRIBE, json.dumps(options).encode('utf-8'))
+        try:
+            self.result(request, wire.ACK)
+        except Error:
+            with self.lock:
+                self.subscriptions.pop(request.requestId, None)
+            raise
+        return self.subscriptions[request.requestId]
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.pop(subscription.subscriptionId, None)
+        subscription.batches.put(None)
+        payload = json.dumps({'id': subscription.subscriptionId}).encode('utf-8')
+        self.result(self.send(wire.UNSUBSCRIBE, payload), wire.ACK)
+
+    def read(self):
+        """ Reader thread that matches responses to the pending requests.
+            Images are written to disk as they arrive and never held in
+            memory as a whole.
+        """
+        header = bytearray(wire.HEADER.size)
+        error = ErrorSocket(self.feeder, 'connection closed')
+        try:
+            while self.recvExactly(memoryview(header)):
+                (msgType, requestId, length) = wire.HEADER.unpack_from(bytes(header))
+                if length > wire.MAX_LENGTH:
+                    raise wire.ErrorFrame('payload of %d bytes is too large' % length)
+                with self.lock:
+                    request = self.pending.get(requestId)
+
+                if request is not None and request.sink is not None and msgType == wire.IMAGE:
+                    try:
+                        payload = request.sink.receive(self.recvExactly, length)
+                    except ErrorChecksum as e:
+                        self.finish(requestId).fail(e)
+                        continue
+                else:
+                    payload = bytearray(length)
+                    if length and not self.recvExactly(memoryview(payload)):
+                        raise ErrorSocket(self.feeder, 'connection closed')
+                    payload = bytes(payload)
+
+                if msgType == wire.READINGS:
+                    with self.lock:
+                        subscription = self.subscriptions.get(requestId)
+                    if subscription is not None:
+                        subscription.batches.put(wire.decodeJson(payload))
+                    continue
+
+                request = self.finish(requestId)
+                if request is not None:
+                    request.done(msgType, payload)
+                elif self.verbosity >= 1:
+                    print('Ignoring response to unknown request %d.' % requestId)
+        except ErrorSocket as e:
+            error = e
+        except (socket.error, IOError, OSError) as e:
+            error = ErrorSocket(self.feeder, e.strerror or str(e))
+        except wire.Error as e:
+            error = ErrorInvalidResponse(self.feeder, e.msg)
+
+        # Fail whatever is still waiting for a response. A partial image is
+        # kept so that it can be resumed.
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+            subscriptions = list(self.subscriptions.values())
+            self.subscriptions.clear()
+        for request in pending:
+            request.fail(error)
+        for subscription in subscriptions:
+            subscription.batches.put(None)
+
+    def finish(self, requestId):
+        with self.lock:
+            return self.pending.pop(requestId, None)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        self.reader.join(self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
 
 
 class PiFeedControl(object):
     """ Implements the control module.
     """
-    def __init__(self, verbosity, feeder, man, times, days, camera, sensor):
-        self.rasp1Host = 'localhost'
-        self.rasp1Port = 8080
-        self.rasp1Size = 1024
-        self.rasp1RcvdData = 0
-        self.rasp2Host = '10.0.0.12'
-        self.rasp2Port = 8080
-        self.rasp2Size = 1024
-        self.rasp2RcvdData = 0
+    def __init__(self, verbosity, feeders, man, times, days, exprs, camera, sensor, workers=32):
+        self.feeders = feeders
+        self.recvSize = 65536
         self.verbosity = verbosity
+        self.imageFile = '%s.jpg'
+        self.sensorReadings = {}
+        self.fanOut = fleet.FanOut(verbosity, workers)
         self.config = {
-            'feeder': feeder,      # Feeder to connect to
+            'feeder': None,        # Feeder to connect to
             'man': man,            # Boolean true if manual feed
             'camera': camera,      # Frames per second of the camera
-            'sensor': sensor,      # Number of times to read temp sensor
+            'sensor': sensor,      # Sensor readings per second
             'auto': {              # Dictionary for automatic configuration
                 'times': times,    # List of times during the day to feed
-                'days': days       # 7 bits bitstring high on the days to feed
+                'days': days,      # 7 bits bitstring high on the days to feed
+                'exprs': exprs     # List of schedule expressions
             }
         }
 
-    def feed(self):
-        # If the request to configure is ready, send the message to the server.
-        if self.config['feeder'] == 'RASPF1':
-            # Connect to RASPF1.
-            serverAddress = (self.rasp1Host, self.rasp1Port)
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(serverAddress)
-                sock.send(json.dumps(self.config))
-            except socket.error as e:
-                raise ErrorSocket(self.config['feeder'], e.strerror)
-            if self.verbosity >= 1:
-                print('Connected to server %s at %s.' % serverAddress)
-
+    def session(self, feeder=None):
+        """ Opens a PiFeedSession with a feeder, the first one by default,
+            which can be reused for any number of requests.
+        """
+        if feeder is None:
+            feeder = self.feeders[0]
+        return PiFeedSession(self.verbosity, feeder.name, feeder.host, feeder.port, recvSize=self.recvSize)
+
+    def feed(self, image=False, sensor=False):
+        """ Sends the configuration to every feeder at once and returns a
+            list of fleet.Results.
+        """
+        results = self.fanOut.run(self.feeders, lambda feeder: self.feedOne(feeder, image, sensor))
+        for result in results:
+            if result.error is None:
+                print('%s: Configuration accepted in %.1f ms.' % (result.feeder.name, result.latency * 1e3))
+            else:
+                print('%s: %s' % (result.feeder.name, result.error))
+        if len(results) > 1:
+            failed = len([result for result in results if result.error is not None])
+            slowest = max(result.latency for result in results)
+            print('%d of %d feeders configured, slowest in %.1f ms.' % (len(results) - failed, len(results), slowest * 1e3))
+        return results
+
+    def feedOne(self, feeder, image=False, sensor=False):
+        """ Sends the configuration to a feeder, optionally fetching the
+            latest camera image and sensor reading on the same connection.
+        """
+        config = dict(self.config)
+        config['feeder'] = feeder.name
+        with self.session(feeder) as session:
+            # Pipeline the requests and collect the responses as they come.
+            requests = [session.sendConfig(config)]
+            if image:
+                requests.append(session.sendImage(self.imageFile % feeder.name))
+            if sensor:
+                requests.append(session.sendSensor())
+
+            session.result(requests[0], wire.ACK)
+            for request in requests[1:]:
+                if request.msgType == wire.IMAGE:
+                    path = session.result(request, wire.IMAGE)
+                    print('%s: Pi camera image saved to %s.' % (feeder.name, path))
+                else:
+                    self.sensorReadings[feeder.name] = wire.decodeJson(session.result(request, wire.SENSOR))
+                    print('%s: Sensor reading: %s' % (feeder.name, self.sensorReadings[feeder.name]))
+
+
+    def stream(self, interval):
+        """ Prints the sensor readings of the first feeder as they are pushed
+            until interrupted.
+        """
+        with self.session() as session:
+            subscription = session.subscribe(interval)
+            while True:
+                (readings, dropped) = subscription.get(1)
+                if dropped:
+                    print('%s: %d readings dropped.' % (self.feeders[0].name, dropped))
+                for reading in readings:
+                    print('%s: Sensor reading: %s' % (self.feeders[0].name, reading))
+
+
+class PiFeedBatch(object):
+    """ Runs a batch of commands against the feeders of the inventory.
+
+        Commands are JSON objects, one per line, with the feeders to run on
+        (a name, a list of names or ALL), the op (config, feed, image or
+        sensor) and the arguments of the op. The commands of each feeder are
+        pipelined over a single session, in order, while all feeders are
+        worked on at once. Every command of every feeder yields one JSON
+        result line, in the order of the input, with its timing.
+    """
+    def __init__(self, verbosity, inventory, workers=32, output=sys.stdout):
+        self.verbosity = verbosity
+        self.inventory = inventory
+        self.recvSize = 65536
+        self.fanOut = fleet.FanOut(verbosity, workers)
+        self.output = output
+        self.ops = ['config', 'feed', 'image', 'sensor']
+
+    def parse(self, lines):
+        """ Returns an ordered dictionary mapping feeder names to their list
+            of (lineNo, command), and the results of the bad lines.
+        """
+        plan = collections.OrderedDict()
+        results = []
+        for (lineNo, line) in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
             try:
-                while True:
-                    recvData = sock.recv(self.rasp1Size)
-                    filename = 'blah.jpg'
-                    if recvData == 'camera':
-                        sock.send('ACK')
-                        f = open(filename, "wb")
-                        while True:
-                            data = sock.recv(8024)
-                            if not data:
-                                break
-                            f.write(data)
-                        sock.send('ACK')
-                        print("Pi camera image received successfully")
-
-                    elif recvData == 'sensor':
-                        sock.send('ACK')
-                        sensorRead = ''
-                        reading = sock.recv(8024)
-                        while True:
-                            if not reading:
-                                break
-                            sensorRead += reading
-                        sock.send('ACK')
-                        if self.verbosity >= 1:
-                            print('Received sensor reading.')
+                command = json.loads(line)
+                if not isinstance(command, dict):
+                    raise ValueError('expected an object')
+                if command.get('op') not in self.ops:
+                    raise ValueError('op must be one of ' + ', '.join(self.ops))
+                names = command.get('feeder', 'ALL')
+                if names == 'ALL':
+                    names = list(self.inventory)
+                elif not isinstance(names, list):
+                    names = [names]
+            except ValueError as e:
+                results.append(self.result(lineNo, None, {}, error='error: bad command: %s' % e))
+                continue
+            for name in names:
+                if name in self.inventory:
+                    plan.setdefault(name, []).append((lineNo, command))
+                else:
+                    results.append(self.result(lineNo, name, command, error='error: feeder %s is not in the inventory' % name))
+        return (plan, results)
+
+    def run(self, lines):
+        """ Runs the commands in lines, writes their results and returns them.
+        """
+        (plan, results) = self.parse(lines)
+        feeders = [self.inventory[name] for name in plan]
+        for fanResult in self.fanOut.run(feeders, lambda feeder: self.runFeeder(feeder, plan[feeder.name])):
+            if fanResult.error is None:
+                results.extend(fanResult.value)
+            else:
+                # The feeder could not be reached at all.
+                for (lineNo, command) in plan[fanResult.feeder.name]:
+                    results.append(self.result(lineNo, fanResult.feeder.name, command, error=fanResult.error, elapsed=fanResult.latency))
+
+        results.sort(key=lambda result: result['line'])
+        for result in results:
+            self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+        return results
+
+    def runFeeder(self, feeder, commands):
+        """ Pipelines the commands of a feeder over one session and returns
+            their results.
+        """
+        # Keep the sessions quiet so that only results go to the output.
+        results = []
+        with PiFeedSession(0, feeder.name, feeder.host, feeder.port, recvSize=self.recvSize) as session:
+            sent = []
+            for (lineNo, command) in commands:
+                try:
+                    sent.append((lineNo, command, self.send(session, feeder, command)))
+                except (Error, TypeError, ValueError) as e:
+                    results.append(self.result(lineNo, feeder.name, command, error=getattr(e, 'msg', 'error: %s' % e)))
+
+            for (lineNo, command, request) in sent:
+                try:
+                    value = self.collect(session, request)
+                except Error as e:
+                    results.append(self.result(lineNo, feeder.name, command, error=e.msg, elapsed=request.elapsed))
+                else:
+                    results.append(self.result(lineNo, feeder.name, command, value=value, elapsed=request.elapsed))
+        return results
+
+    def send(self, session, feeder, command):
+        op = command['op']
+        if op == 'config':
+            config = {
+                'feeder': feeder.name,
+                'man': bool(command.get('man', False)),
+                'camera': int(command.get('camera', 0)),
+                'sensor': float(command.get('sensor', 0)),
+                'auto': {
+                    'times': list(command.get('times', [])),
+                    'days': list(command.get('days', [])),
+                    'exprs': list(command.get('exprs', []))
+                }
+            }
+            return session.sendConfig(config)
+        elif op == 'feed':
+            return session.sendFeed()
+        elif op == 'image':
+            return session.sendImage(command.get('path', '%s.jpg' % feeder.name))
+        return session.sendSensor()
+
+    def collect(self, session, request):
+        if request.msgType == wire.IMAGE:
+            return session.result(request, wire.IMAGE)
+        elif request.msgType == wire.SENSOR:
+            return wire.decodeJson(session.result(request, wire.SENSOR))
+        session.result(request, wire.ACK)
+        return None
+
+    def result(self, lineNo, feederName, command, value=None, error=None, elapsed=None):
+        result = {
+            'line': lineNo,
+            'feeder': feederName,
+            'op': command.get('op'),
+            'ok': error is None,
+            'ms': None if elapsed is None else round(elapsed * 1e3, 3)
+        }
+        if 'id' in command:
+            result['id'] = command['id']
+        if error is None:
+            result['result'] = value
+        else:
+            result['error'] = error
+        return result
+
+
+def selectFeeders(inventory, names, ip, port):
+    """ Returns the Feeders named on the command line. A single feeder can be
+        given an address of its own with ip and port.
+    """
+    if 'ALL' in names:
+        names = list(inventory)
+    if ip is not None or port is not None:
+        if len(names) != 1:
+            raise fleet.Error('an IP address or port can only be given for a single feeder')
+        feeder = inventory.get(names[0], fleet.Feeder(names[0], 'localhost', 8080))
+        return [feeder._replace(host=ip or feeder.host, port=port or feeder.port)]
+    for name in names:
+        if name not in inventory:
+            raise fleet.Error('feeder %s is not in the inventory' % name)
+    return [inventory[name] for name in names]
+
+
+def runBatch(args, inventory):
+    """ Runs a batch file and exits with 1 if any of its commands failed.
+    """
+    start = time.time()
+    batch = PiFeedBatch(args.verbosity, inventory, args.workers)
+    try:
+        if args.batch == '-':
+            results = batch.run(sys.stdin.readlines())
+        else:
+            with open(args.batch, 'r') as f:
+                results = batch.run(f.readlines())
+    except IOError as e:
+        raise fleet.Error('cannot read batch file %s: %s' % (args.batch, e.strerror))
 
-            except socket.error as e:
-                raise ErrorSocket(self.config['feeder'], e.strerror)
-            except ValueError:
-                raise ErrorInvalidResponse(self.config['feeder'], recvData)
+    failed = len([result for result in results if not result['ok']])
+    if args.verbosity >= 1:
+        sys.stderr.write('%d of %d commands succeeded in %.1f ms.\n' % (len(results) - failed, len(results), (time.time() - start) * 1e3))
+    sys.exit(1 if failed else 0)
 
 
 def main():
@@ -176,15 +777,27 @@ def main():
     args = args.args
 
     try:
-        pfc = PiFeedControl(args.verbosity, args.feeder, args.man, args.times, args.days, args.camera, args.sensor)
-        pfc.feed()
-    except ErrorSocket as e:
+        inventory = fleet.loadInventory(args.inventory)
+        if args.batch is not None:
+            runBatch(args, inventory)
+        feeders = selectFeeders(inventory, args.feeders, args.ip, args.port)
+        if args.subscribe is not None and len(feeders) != 1:
+            raise fleet.Error('sensor readings can only be streamed from a single feeder')
+        pfc = PiFeedControl(args.verbosity, feeders, args.man, args.times, args.days, args.exprs, args.camera, args.sensor, args.workers)
+        results = pfc.feed(args.image, args.reading)
+        if args.subscribe is not None:
+            pfc.stream(args.subscribe)
+    except fleet.Error as e:
         print(e.msg)
-    except ErrorInvalidResponse as e:
+        sys.exit(1)
+    except (ErrorSocket, ErrorInvalidResponse) as e:
         print(e.msg)
         sys.exit(1)
     except KeyboardInterrupt:
         print('\nClosing.')
+        sys.exit(1)
+    if any(result.error is not None for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,349 @@
+#!/usr/bin/env python2.7
+
+""" Timer engine for the feeder schedules.
+
+Keeps a heap of next-fire times that the feeder polls when the earliest feed
+is due or when someone wakes it up because the configuration changed. Weekly
+schedules are compiled once into an index of minute-of-week offsets.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import array
+import bisect
+import collections
+import datetime
+import heapq
+import itertools
+import threading
+import time
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class FeedScheduler(object):
+    """ Heap of scheduled feeds keyed by an arbitrary hashable key.
+
+        Removed entries are only marked as cancelled and get discarded lazily
+        when they reach the top of the heap, so adding and removing are both
+        O(log n).
+    """
+    def __init__(self, timefunc=time.time):
+        self.timefunc = timefunc
+        self.lock = threading.Lock()
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.changed = False
+
+    def add(self, key, fireTime):
+        """ Schedules key to fire at the absolute time fireTime, replacing any
+            previous entry for the same key.
+        """
+        with self.lock:
+            self._push(key, fireTime)
+
+    def remove(self, key):
+        """ Removes key from the schedule if it is scheduled.
+        """
+        with self.lock:
+            self._cancel(key)
+            self._compact()
+
+    def apply(self, delta, fireTime):
+        """ Applies a SchedDelta under a single lock, where fireTime is called
+            with each added key to get its absolute fire time.
+        """
+        with self.lock:
+            for key in delta.removed:
+                self._cancel(key)
+            for key in delta.added:
+                self._push(key, fireTime(key))
+            self._compact()
+
+    def wakeup(self):
+        """ Makes the next poll return an empty list so the feeder reloads
+            its configuration.
+        """
+        with self.lock:
+            self.changed = True
+
+    def woken(self):
+        """ Returns True if wakeup was called since the last poll.
+        """
+        with self.lock:
+            return self.changed
+
+    def peek(self):
+        """ Returns the earliest fire time, or None if nothing is scheduled.
+        """
+        with self.lock:
+            return self._peek()
+
+    def popDue(self, now):
+        """ Removes and returns a list of (fireTime, key) for every entry due
+            at or before now, earliest first.
+        """
+        with self.lock:
+            return self._popDue(now)
+
+    def poll(self):
+        """ Returns the due entries as popDue does, an empty list if woken up
+            by wakeup, or None if nothing is due.
+        """
+        with self.lock:
+            return self._poll(self.timefunc())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _push(self, key, fireTime):
+        self._cancel(key)
+        entry = [fireTime, next(self.counter), key, True]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def _cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[-1] = False
+
+    def _compact(self):
+        # Rebuild the heap once cancelled entries outnumber the live ones so
+        # that config churn cannot grow it without bound.
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if entry[-1]]
+            heapq.heapify(self.heap)
+
+    def _peek(self):
+        while self.heap and not self.heap[0][-1]:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
+    def _poll(self, now):
+        if self.changed:
+            self.changed = False
+            return []
+        fireTime = self._peek()
+        if fireTime is not None and fireTime <= now:
+            return self._popDue(now)
+        return None
+
+    def _popDue(self, now):
+        due = []
+        while True:
+            fireTime = self._peek()
+            if fireTime is None or fireTime > now:
+                break
+            entry = heapq.heappop(self.heap)
+            del self.entries[entry[2]]
+            due.append((entry[0], entry[2]))
+        return due
+
+
+SchedDelta = collections.namedtuple('SchedDelta', ['added', 'removed'])
+
+
+def diffSched(old, new):
+    """ Compares two sorted sequences of schedule keys with a single merge
+        pass and returns a SchedDelta of the keys only in new and the keys
+        only in old. Runs in O(len(old) + len(new)).
+    """
+    added = []
+    removed = []
+    i = 0
+    j = 0
+    while i < len(old) and j < len(new):
+        if old[i] == new[j]:
+            i += 1
+            j += 1
+        elif old[i] < new[j]:
+            removed.append(old[i])
+            i += 1
+        else:
+            added.append(new[j])
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return SchedDelta(added, removed)
+
+
+DAYS_OF_WEEK = {
+    'MON': 0,
+    'TUE': 1,
+    'WED': 2,
+    'THU': 3,
+    'FRI': 4,
+    'SAT': 5,
+    'SUN': 6
+}
+
+WEEK_OF_DAYS = dict((day, name) for (name, day) in DAYS_OF_WEEK.items())
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+def minuteOfWeek(dt):
+    """ Returns the minute of the week of dt, counting from Monday 00:00.
+    """
+    return dt.weekday() * MINUTES_PER_DAY + dt.hour * 60 + dt.minute
+
+
+def weekStart(dt):
+    """ Returns midnight of the Monday of the week of dt.
+    """
+    monday = dt.date() - datetime.timedelta(days=dt.weekday())
+    return datetime.datetime.combine(monday, datetime.time(0))
+
+
+def parseTime(text):
+    """ Returns the minute of the day of an 'HH:MM' time.
+    """
+    try:
+        (hour, minute) = text.split(':')
+    except (AttributeError, ValueError):
+        raise Error('invalid time "%s"' % (text,))
+    if not (hour.isdigit() and minute.isdigit() and int(hour) <= 23 and int(minute) <= 59):
+        raise Error('invalid time "%s"' % (text,))
+    return int(hour) * 60 + int(minute)
+
+
+def formatOffset(offset):
+    """ Returns a minute of the week as a string such as 'TUE 14:15'.
+    """
+    (day, minute) = divmod(offset, MINUTES_PER_DAY)
+    return '%s %02d:%02d' % (WEEK_OF_DAYS[day], minute // 60, minute % 60)
+
+
+class WeekIndex(object):
+    """ Weekly schedule compiled into minute-of-week offsets.
+
+        The offsets are kept both as a sorted array, for finding the next feed
+        with a binary search, and as a 10,080 bit bitmap, for checking whether
+        a feed is due in constant time.
+    """
+    def __init__(self, offsets):
+        self.offsets = array.array('H', sorted(set(offsets)))
+        self.bitmap = bytearray(MINUTES_PER_WEEK // 8)
+        for offset in self.offsets:
+            self.bitmap[offset >> 3] |= 1 << (offset & 7)
+
+    @classmethod
+    def fromTimes(cls, times, days):
+        """ Compiles the cross product of a list of 'HH:MM' times and a list
+            of days of the week. Raises Error for a time or day that is not
+            valid.
+        """
+        dayOffsets = set()
+        for day in days:
+            if day == 'ALL':
+                dayOffsets.update(DAYS_OF_WEEK.values())
+            elif day != 'NONE':
+                try:
+                    dayOffsets.add(DAYS_OF_WEEK[day])
+                except (KeyError, TypeError):
+                    raise Error('invalid day "%s"' % (day,))
+
+        minutes = set()
+        for curTime in times:
+            minutes.add(parseTime(curTime))
+
+        return cls(day * MINUTES_PER_DAY + minute for day in dayOffsets for minute in minutes)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __or__(self, other):
+        return WeekIndex(list(self.offsets) + list(other.offsets))
+
+    def __contains__(self, offset):
+        return bool(self.bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def isDue(self, dt):
+        """ Returns True if a feed is scheduled in the minute of dt.
+        """
+        return minuteOfWeek(dt) in self
+
+    def nextOffset(self, offset):
+        """ Returns the first scheduled offset strictly after offset, which is
+            larger than MINUTES_PER_WEEK if it falls in the following week, or
+            None if nothing is scheduled.
+        """
+        if not self.offsets:
+            return None
+        i = bisect.bisect_right(self.offsets, offset)
+        if i < len(self.offsets):
+            return self.offsets[i]
+        return self.offsets[0] + MINUTES_PER_WEEK
+
+    def nextAfter(self, dt):
+        """ Returns the datetime of the first feed strictly after dt, or None
+            if nothing is scheduled.
+        """
+        offset = self.nextOffset(minuteOfWeek(dt))
+        if offset is None:
+            return None
+        return weekStart(dt) + datetime.timedelta(minutes=offset)
+
+    def fireTime(self, offset, now):
+        """ Returns the timestamp of the first occurrence of offset strictly
+            after the timestamp now.
+        """
+        nowDt = datetime.datetime.fromtimestamp(now)
+        dt = weekStart(nowDt) + datetime.timedelta(minutes=offset)
+        if dt <= nowDt:
+            dt += datetime.timedelta(days=7)
+        return time.mktime(dt.timetuple())
+
+
+MAX_ONE_SHOTS = 16
+ONE_SHOT_GRACE = 3600
+
+
+class OneShotQueue(object):
+    """ Bounded queue of one-shot feeds keyed by absolute timestamp, kept
+        apart from the weekly schedule so manual feeds do not recur.
+    """
+    def __init__(self, times=(), maxLen=MAX_ONE_SHOTS):
+        self.times = sorted(set(times))
+        self.maxLen = maxLen
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        return iter(self.times)
+
+    def push(self, when):
+        """ Queues a feed at the timestamp when. Returns False if the queue is
+            full.
+        """
+        if when in self.times:
+            return True
+        if len(self.times) >= self.maxLen:
+            return False
+        bisect.insort(self.times, when)
+        return True
+
+    def discard(self, when):
+        """ Removes the feed at the timestamp when if it is queued.
+        """
+        i = bisect.bisect_left(self.times, when)
+        if i < len(self.times) and self.times[i] == when:
+            del self.times[i]
+
+    def expire(self, now, grace=ONE_SHOT_GRACE):
+        """ Drops feeds that are more than grace seconds overdue, which can
+            only happen if the feeder was not running when they were due.
+        """
+        i = bisect.bisect_right(self.times, now - grace)
+        del self.times[:i]
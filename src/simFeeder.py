@@ -0,0 +1,263 @@
+#!/usr/bin/env python2.7
+
+""" Simulates a feeder against a virtual clock.
+
+Runs the Feeder and Config classes of the pifeed daemon with a virtual clock
+and a fake actuator, so months of scheduled feeds, manual feeds and
+configuration changes play out in seconds. Reports the feeds that fired, the
+feeds that were missed and the jitter between the scheduled and the actual
+feeding times.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import argparse
+import datetime
+import heapq
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import configstore
+import cron
+import pifeed
+import schedule
+
+
+class VirtualClock(object):
+    """ Clock that only moves when the simulation or the actuator moves it.
+        Has the time and sleep functions of the time module.
+    """
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def advance(self, when):
+        if when > self.now:
+            self.now = when
+
+
+class FakeActuator(object):
+    """ Stands in for fish.Fish and cat.Cat and records when feeding started.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.feeds = []
+
+    def feed(self, feedTime):
+        self.feeds.append(self.clock.time())
+        self.clock.sleep(feedTime)
+
+    def water(self, pourTime):
+        self.clock.sleep(pourTime)
+
+
+class Simulation(object):
+    """ Drives a Feeder through a virtual time span.
+    """
+    def __init__(self, verbosity, start, days, churn, manual, latency, workDir):
+        self.verbosity = verbosity
+        self.start = start
+        self.end = start + days * 86400
+        self.latency = latency
+        self.feederName = 'SIM'
+
+        self.clock = VirtualClock(start)
+        self.actuator = FakeActuator(self.clock)
+        self.store = configstore.ConfigStore(0, self.feederName, os.path.join(workDir, self.feederName + '.config'))
+
+        # Keep the schedule that was in force after every change so the
+        # expected feeds can be worked out independently of the feeder.
+        self.history = []
+        self.oneShots = set()
+        self.store.subscribe(self.configChanged)
+        self.store.commit(self.randomConfig(), persist=False)
+
+        self.config = pifeed.Config(0, self.feederName, self.store, False, [], [], [], 0, 0, clock=self.clock)
+        self.feeder = pifeed.Feeder(0, self.feederName, self.store, self.clock, self.actuator)
+
+        # Events are (time, kind) pairs for configuration churn and manual
+        # feeding requests.
+        self.events = []
+        self.counts = {'churn': 0, 'manual': 0}
+        self.addEvents('churn', churn)
+        self.addEvents('manual', manual)
+        self.scheduled = []
+
+    def addEvents(self, kind, meanDays):
+        if meanDays <= 0:
+            return
+        when = self.start
+        while True:
+            when += random.expovariate(1.0 / (meanDays * 86400))
+            if when >= self.end:
+                break
+            heapq.heappush(self.events, (when, kind))
+
+    def randomConfig(self):
+        times = ['%02d:%02d' % (random.randrange(24), random.randrange(60)) for i in range(random.randint(1, 4))]
+        days = random.sample(sorted(schedule.DAYS_OF_WEEK), random.randint(1, 7))
+        exprs = []
+        if random.random() < 0.3:
+            exprs.append('every %d minutes between %02d:00 and %02d:00 on weekdays' % (random.randint(30, 180), random.randrange(12), random.randrange(12, 24)))
+        return {
+            'feeder': self.feederName,
+            'man': False,
+            'camera': 1,
+            'sensor': 1,
+            'auto': {
+                'times': times,
+                'days': days,
+                'exprs': exprs
+            }
+        }
+
+    def configChanged(self, version, snapshot):
+        auto = snapshot['auto']
+        index = schedule.WeekIndex.fromTimes(auto['times'], auto['days'])
+        for expr in auto.get('exprs', ()):
+            index = index | cron.compileExpr(expr)
+        self.history.append((self.clock.time(), index))
+        self.oneShots.update(snapshot.get('once', ()))
+
+    def runEvent(self, kind):
+        self.counts[kind] += 1
+        self.config.readConfig()
+        if kind == 'churn':
+            self.config.newConfig = self.randomConfig()
+            self.config.updateConfig()
+        else:
+            self.config.newConfig = {
+                'feeder': self.feederName,
+                'man': True,
+                'camera': 0,
+                'sensor': 0,
+                'auto': {
+                    'times': [],
+                    'days': [],
+                    'exprs': []
+                }
+            }
+            self.config.processMan()
+
+    def drain(self):
+        """ Lets the feeder handle everything that is due at the current time.
+        """
+        while True:
+            due = self.feeder.scheduler.poll()
+            if due is None:
+                return
+            self.scheduled.extend(fireTime for (fireTime, key) in due)
+            self.feeder.process(due)
+
+    def run(self):
+        self.drain()
+        while True:
+            nextFeed = self.feeder.scheduler.peek()
+            nextEvent = self.events[0][0] if self.events else None
+            if nextEvent is not None and (nextFeed is None or nextEvent < nextFeed):
+                if nextEvent > self.end:
+                    break
+                (when, kind) = heapq.heappop(self.events)
+                self.clock.advance(when)
+                self.runEvent(kind)
+            elif nextFeed is not None and nextFeed <= self.end:
+                # Model the time it takes the OS to wake the feeder thread up.
+                self.clock.advance(nextFeed + random.uniform(0, self.latency))
+            else:
+                break
+            self.drain()
+
+    def expected(self):
+        """ Returns the set of fire times implied by the configuration history
+            and the one-shot feeds that were queued.
+        """
+        expected = set()
+        bounds = [when for (when, index) in self.history[1:]] + [self.end]
+        for ((since, index), until) in zip(self.history, bounds):
+            week = schedule.weekStart(datetime.datetime.fromtimestamp(since))
+            while time.mktime(week.timetuple()) <= until:
+                for offset in index.offsets:
+                    fireTime = time.mktime((week + datetime.timedelta(minutes=offset)).timetuple())
+                    if since < fireTime <= until:
+                        expected.add(fireTime)
+                week += datetime.timedelta(days=7)
+        expected.update(when for when in self.oneShots if when <= self.end)
+        return expected
+
+    def report(self, elapsed):
+        expected = self.expected()
+        fired = set(self.scheduled)
+        missed = sorted(expected - fired)
+        unexpected = sorted(fired - expected)
+        jitter = sorted(actual - scheduled for (scheduled, actual) in zip(self.scheduled, self.actuator.feeds))
+
+        days = (self.end - self.start) / 86400
+        print('Simulated %d days in %.2f s.' % (days, elapsed))
+        print('Configuration changes: %d, manual requests: %d.' % (self.counts['churn'], self.counts['manual']))
+        print('Feeds fired: %d, missed: %d, unexpected: %d.' % (len(self.scheduled), len(missed), len(unexpected)))
+        if jitter:
+            mean = sum(jitter) / len(jitter)
+            p99 = jitter[min(len(jitter) - 1, int(len(jitter) * 0.99))]
+            print('Jitter: mean %.2f ms, p99 %.2f ms, max %.2f ms.' % (mean * 1e3, p99 * 1e3, jitter[-1] * 1e3))
+        if self.verbosity >= 1:
+            for fireTime in missed:
+                print('Missed feed at %s.' % datetime.datetime.fromtimestamp(fireTime))
+            for fireTime in unexpected:
+                print('Unexpected feed at %s.' % datetime.datetime.fromtimestamp(fireTime))
+        return len(missed) + len(unexpected)
+
+
+class SimFeederArgs(object):
+    """ Argument parser for the feeder simulation.
+    """
+    def __init__(self):
+        self.name = 'simfeeder'
+        self.desc = 'Simulates the feeding scheduler against a virtual clock.'
+
+        self.daysHelp = 'Number of days to simulate. Default is 365.'
+        self.churnHelp = 'Mean number of days between configuration changes. Zero disables them.'
+        self.manualHelp = 'Mean number of days between manual feeding requests. Zero disables them.'
+        self.latencyHelp = 'Largest wakeup latency of the feeder thread in seconds.'
+        self.seedHelp = 'Seed for the random configuration changes.'
+        self.verbHelp = 'Increase output verbosity.'
+
+        self.argParser = argparse.ArgumentParser(prog=self.name, description=self.desc)
+        self.argParser.add_argument('-n', '--days', type=int, dest='days', default=365, help=self.daysHelp)
+        self.argParser.add_argument('-c', '--churn', type=float, dest='churn', default=7, help=self.churnHelp)
+        self.argParser.add_argument('-m', '--manual', type=float, dest='manual', default=3, help=self.manualHelp)
+        self.argParser.add_argument('-l', '--latency', type=float, dest='latency', default=0.002, help=self.latencyHelp)
+        self.argParser.add_argument('-s', '--seed', type=int, dest='seed', default=0, help=self.seedHelp)
+        self.argParser.add_argument('-v', '--verbosity', action='count', default=0, help=self.verbHelp)
+
+    def parse(self):
+        self.args = self.argParser.parse_args()
+
+
+def main():
+    args = SimFeederArgs()
+    args.parse()
+    args = args.args
+
+    random.seed(args.seed)
+    workDir = tempfile.mkdtemp(prefix='simfeeder')
+    try:
+        sim = Simulation(args.verbosity, time.time(), args.days, args.churn, args.manual, args.latency, workDir)
+        start = time.time()
+        sim.run()
+        errors = sim.report(time.time() - start)
+    finally:
+        shutil.rmtree(workDir)
+    sys.exit(1 if errors else 0)
+
+if __name__ == '__main__':
+    main()
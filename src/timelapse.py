@@ -0,0 +1,317 @@
+#!/usr/bin/env python2.7
+
+""" Time-lapse archive of the camera frames.
+
+Frames are appended to segment files, each holding the frames of at most one
+hour back to back. Next to every segment is an index of fixed-size records of
+the capture time, offset and length of its frames, in capture order, so the
+frame nearest to a time or the frames of a time range are found with a binary
+search over a few records instead of a scan of the frames. The oldest segments
+are removed once the archive goes over its size or age budget.
+
+Run as a script, exports frames from an archive:
+
+    timelapse.py _lapse/RASPF1 -a "2016-05-01 08:00" -o frame.jpg
+    timelapse.py _lapse/RASPF1 -s "2016-05-01 08:00" -e "2016-05-01 09:00" -o frames
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import argparse
+import bisect
+import errno
+import os
+import struct
+import sys
+import threading
+import time
+
+
+# Capture time, offset and length of a frame.
+RECORD = struct.Struct('!dII')
+
+
+class Segment(object):
+    """ A segment file of frames and its index. Only the first count records
+        of the index are read, so the segment can be read while frames are
+        appended to it.
+    """
+    def __init__(self, directory, start):
+        self.start = start
+        self.dataPath = os.path.join(directory, '%010d.jpgs' % start)
+        self.indexPath = os.path.join(directory, '%010d.idx' % start)
+        self.size = 0
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def load(self):
+        """ Reads the size and the time span of a segment on disk. Records
+            that were torn by a crash, or point past the end of the frames,
+            are left out.
+        """
+        self.size = os.path.getsize(self.dataPath)
+        self.count = os.path.getsize(self.indexPath) // RECORD.size
+        with open(self.indexPath, 'rb') as index:
+            while self.count > 0:
+                (when, offset, length) = self.record(index, self.count - 1)
+                if offset + length <= self.size:
+                    break
+                self.count -= 1
+            if self.count > 0:
+                self.first = self.record(index, 0)[0]
+                self.last = self.record(index, self.count - 1)[0]
+
+    def record(self, index, i):
+        index.seek(i * RECORD.size)
+        return RECORD.unpack(index.read(RECORD.size))
+
+    def search(self, index, when, count):
+        """ Returns the position of the first of count records taken at or
+            after when.
+        """
+        (lo, hi) = (0, count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(index, mid)[0] < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def remove(self):
+        for path in [self.dataPath, self.indexPath]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+
+class Archive(object):
+    """ Archive of the frames of a feeder in directory. A segment is closed
+        after segmentSeconds or segmentBytes, and the oldest segments are
+        removed while the archive is larger than maxBytes or older than
+        maxAge seconds. Frames are appended by one thread and can be read
+        from any number of others.
+    """
+    def __init__(self, verbosity, feederName, directory, maxBytes=256 * 1024 * 1024, maxAge=7 * 86400,
+                 segmentSeconds=3600, segmentBytes=16 * 1024 * 1024):
+        self.verbosity = verbosity
+        self.feederName = feederName
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.segmentSeconds = segmentSeconds
+        self.segmentBytes = segmentBytes
+        self.segments = []
+        self.current = None
+        self.data = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """ Loads the segments on disk. Appending always starts a new
+            segment.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        starts = set()
+        for name in os.listdir(self.directory):
+            (start, ext) = os.path.splitext(name)
+            if ext == '.idx' and start.isdigit():
+                starts.add(int(start))
+        segments = []
+        for start in sorted(starts):
+            segment = Segment(self.directory, start)
+            try:
+                segment.load()
+            except (IOError, OSError, struct.error):
+                if self.verbosity >= 1:
+                    print('%s: Skipping broken time-lapse segment %s.' % (self.feederName, segment.dataPath))
+                continue
+            if segment.count > 0:
+                segments.append(segment)
+            else:
+                segment.remove()
+        with self.lock:
+            self.segments = segments
+        if self.verbosity >= 1:
+            print('%s: Time-lapse archive has %d frames in %d segments.' % (self.feederName, sum(s.count for s in segments), len(segments)))
+
+    def close(self):
+        with self.lock:
+            self.closeSegment()
+
+    def closeSegment(self):
+        if self.current is not None:
+            self.data.close()
+            self.index.close()
+            (self.current, self.data, self.index) = (None, None, None)
+
+    def append(self, data, when=None):
+        """ Appends a frame taken at when, which is never earlier than the
+            last frame appended.
+        """
+        if when is None:
+            when = time.time()
+        with self.lock:
+            segment = self.current
+            if (segment is None or when >= segment.start + self.segmentSeconds or
+                    segment.size + len(data) > self.segmentBytes):
+                self.closeSegment()
+                segment = Segment(self.directory, int(when))
+                if self.segments and self.segments[-1].start >= segment.start:
+                    segment = Segment(self.directory, self.segments[-1].start + 1)
+                self.data = open(segment.dataPath, 'ab')
+                self.index = open(segment.indexPath, 'ab')
+                self.current = segment
+                self.segments.append(segment)
+
+            # The frame is written before its record, so a record never
+            # points at a frame that is not on disk.
+            self.data.write(data)
+            self.data.flush()
+            self.index.write(RECORD.pack(when, segment.size, len(data)))
+            self.index.flush()
+            segment.size += len(data)
+            segment.count += 1
+            if segment.first is None:
+                segment.first = when
+            segment.last = when
+            self.expire(when)
+
+    def expire(self, now):
+        """ Removes the oldest segments until the archive is back in its
+            budget. The segment being appended to is kept.
+        """
+        total = sum(s.size for s in self.segments)
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if total <= self.maxBytes and oldest.last >= now - self.maxAge:
+                break
+            self.segments.pop(0)
+            oldest.remove()
+            total -= oldest.size
+            if self.verbosity >= 2:
+                print('%s: Removed time-lapse segment %s.' % (self.feederName, oldest.dataPath))
+
+    def snapshot(self):
+        """ Returns the segments with the number of frames in each.
+        """
+        with self.lock:
+            return [(segment, segment.count) for segment in self.segments]
+
+    def nearest(self, when):
+        """ Returns the capture time and data of the frame nearest to when, or
+            None if the archive is empty.
+        """
+        segments = self.snapshot()
+        i = bisect.bisect_right([segment.start for (segment, count) in segments], when)
+        best = None
+        # The nearest frame is in the segment that starts before when, or
+        # is the first frame of the next one.
+        for (segment, count) in segments[max(i - 1, 0):i + 1]:
+            try:
+                with open(segment.indexPath, 'rb') as index:
+                    j = segment.search(index, when, count)
+                    for k in [j - 1, j]:
+                        if 0 <= k < count:
+                            record = segment.record(index, k)
+                            if best is None or abs(record[0] - when) < abs(best[1][0] - when):
+                                best = (segment, record)
+            except IOError:
+                # Removed since the snapshot.
+                continue
+        if best is None:
+            return None
+        (segment, (taken, offset, length)) = best
+        try:
+            with open(segment.dataPath, 'rb') as f:
+                f.seek(offset)
+                return (taken, f.read(length))
+        except IOError:
+            return None
+
+    def frames(self, start, end):
+        """ Yields the capture time and data of the frames taken from start to
+            end, in capture order.
+        """
+        for (segment, count) in self.snapshot():
+            if count == 0 or segment.last < start or segment.first > end:
+                continue
+            try:
+                with open(segment.indexPath, 'rb') as index:
+                    with open(segment.dataPath, 'rb') as f:
+                        for k in range(segment.search(index, start, count), count):
+                            (taken, offset, length) = segment.record(index, k)
+                            if taken > end:
+                                break
+                            f.seek(offset)
+                            yield (taken, f.read(length))
+            except IOError:
+                continue
+
+
+def parseTime(text):
+    """ Returns the time given as seconds since the epoch or as a local
+        "YYYY-MM-DD HH:MM[:SS]".
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M']:
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('bad time %s' % text)
+
+
+class TimelapseArgs(object):
+    """ Parses the arguments of the export script.
+    """
+    def __init__(self):
+        self.argParser = argparse.ArgumentParser(prog='timelapse', description='Exports frames from a time-lapse archive.')
+        self.argParser.add_argument('directory', help='Archive directory, such as _lapse/RASPF1.')
+        self.argParser.add_argument('-a', '--at', type=parseTime, dest='at', help='Export the frame nearest to this time.', metavar='\b')
+        self.argParser.add_argument('-s', '--start', type=parseTime, dest='start', help='Export the frames from this time.', metavar='\b')
+        self.argParser.add_argument('-e', '--end', type=parseTime, dest='end', help='Export the frames up to this time. Default is now.', metavar='\b')
+        self.argParser.add_argument('-o', '--output', type=str, dest='output', required=True, help='File of the frame, or directory of the frames.', metavar='\b')
+
+    def parse(self):
+        return self.argParser.parse_args()
+
+
+def main():
+    args = TimelapseArgs().parse()
+    archive = Archive(0, 'timelapse', args.directory)
+    archive.open()
+    if args.at is not None:
+        frame = archive.nearest(args.at)
+        if frame is None:
+            sys.stderr.write('error: archive is empty\n')
+            sys.exit(1)
+        with open(args.output, 'wb') as f:
+            f.write(frame[1])
+        print('%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(frame[0])), args.output))
+    elif args.start is not None:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        count = 0
+        for (taken, data) in archive.frames(args.start, time.time() if args.end is None else args.end):
+            with open(os.path.join(args.output, '%.3f.jpg' % taken), 'wb') as f:
+                f.write(data)
+            count += 1
+        print('%d frames in %s' % (count, args.output))
+    else:
+        sys.stderr.write('error: give --at or --start\n')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
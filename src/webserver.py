@@ -12,9 +12,10 @@ __author__ = 'Danny Duangphachanh, Igor Janjic, Daniel Friedman'
 from twisted.web import server, resource
 from twisted.internet import reactor
 from twisted.web.server import Site
-from twisted.web.static import File
 
-resource = File('/home/pi/PiFeed/src/')
+from infoServer import InfoFile
+
+resource = InfoFile('/home/pi/PiFeed/src/')
 resource.putChild('', resource)
 factory = Site(resource)
 reactor.listenTCP(8000, factory)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2.7
+
+""" Wire protocol between pifeedcontrol and the feeders.
+
+Every message is a frame made of a nine byte header, holding the message type,
+the request ID and the length of the payload in network byte order, followed
+by the payload. Responses carry the ID of the request they answer, so a client
+can keep many requests in flight on one connection and match the responses as
+they come back in any order. Frames are decoded incrementally, so a large
+payload split over many TCP segments and several frames coalesced into one
+segment are both handled.
+
+IMAGE requests carry a JSON payload with the byte offset to resume from and
+the CRC-32 of the image the client already has part of. The IMAGE response
+starts with an image header, holding the size of the whole image, the offset
+the data starts at and the CRC-32 of the whole image, followed by the image
+data from that offset on.
+
+A SUBSCRIBE request is answered with an ACK and then with READINGS frames
+carrying its request ID. The feeder only sends as many batches as the client
+has credit for, and the client returns credit with CREDIT frames, tagged with
+the same ID, as it consumes the batches.
+"""
+
+__author__ = 'Igor Janjic, Danny Duangphachanh, Daniel Friedman'
+__version__ = '0.1'
+
+import json
+import struct
+
+
+# Message types.
+CONFIG = 1      # JSON configuration sent to a feeder
+ACK = 2         # Request succeeded, JSON payload
+ERROR = 3       # Request failed, UTF-8 error message
+IMAGE = 4       # Request for, or JPEG image from, the camera
+SENSOR = 5      # Request for, or JSON reading from, the sensor
+FEED = 6        # Request to feed right away
+SUBSCRIBE = 7   # Request to have sensor readings pushed, JSON options
+READINGS = 8    # Batch of sensor readings pushed to a subscriber, JSON
+CREDIT = 9      # Subscriber is ready for more batches, JSON, not answered
+UNSUBSCRIBE = 10    # Request to stop a subscription, JSON
+
+HEADER = struct.Struct('!BII')
+IMAGE_HEADER = struct.Struct('!III')
+MAX_LENGTH = 16 * 1024 * 1024
+
+
+class Error(Exception):
+    """ Base exception for the module.
+    """
+    def __init__(self, msg):
+        self.msg = 'error: %s' % msg
+
+
+class ErrorFrame(Error):
+    """ Raised when a frame cannot be decoded.
+    """
+    def __init__(self, reason):
+        self.msg = 'error: bad frame: %s' % reason
+
+
+def encode(msgType, requestId, payload=b''):
+    """ Returns the frame of a message.
+    """
+    return HEADER.pack(msgType, requestId, len(payload)) + payload
+
+
+def encodeJson(msgType, requestId, obj):
+    """ Returns the frame of a message with a JSON payload.
+    """
+    return encode(msgType, requestId, json.dumps(obj).encode('utf-8'))
+
+
+def decodeJson(payload):
+    """ Returns the object in a JSON payload.
+    """
+    try:
+        return json.loads(payload.decode('utf-8'))
+    except ValueError as e:
+        raise ErrorFrame('invalid JSON payload: %s' % e)
+
+
+class FrameDecoder(object):
+    """ Incremental frame decoder.
+
+        Received data is appended to a single bytearray and frames are parsed
+        in place at a read offset, so a frame arriving in many pieces is never
+        rebuilt by repeated concatenation.
+    """
+    def __init__(self, maxLength=MAX_LENGTH):
+        self.maxLength = maxLength
+        self.buf = bytearray()
+        self.offset = 0
+
+    def feed(self, data):
+        """ Adds received data and returns a list of (msgType, requestId,
+            payload) for every frame completed by it.
+        """
+        self.buf.extend(data)
+        frames = []
+        while len(self.buf) - self.offset >= HEADER.size:
+            (msgType, requestId, length) = HEADER.unpack_from(self.buf, self.offset)
+            if length > self.maxLength:
+                raise ErrorFrame('payload of %d bytes is too large' % length)
+            start = self.offset + HEADER.size
+            end = start + length
+            if len(self.buf) < end:
+                break
+            frames.append((msgType, requestId, bytes(self.buf[start:end])))
+            self.offset = end
+
+        # Drop the consumed frames once per call rather than once per frame.
+        if self.offset:
+            del self.buf[:self.offset]
+            self.offset = 0
+        return frames
+
+    def pending(self):
+        """ Returns the number of buffered bytes of incomplete frames.
+        """
+        return len(self.buf) - self.offset